@@ -0,0 +1,126 @@
+"""
+Benchmark of the definition time of many generated workflows and workflow enabled proxy models,
+i.e. the import time cost of kworkflows at process startup, with eager or lazy workflows compilation,
+and of --calls calls per mother class of get_aggregated_states and get_initial_state, cached or recomputed at each call.
+Each mode runs in fresh processes, the best of --repeat runs is kept.
+Usage: python benchmarks/startup.py [--families 10] [--workflows 30] [--states 20] [--transitions 30] [--calls 100]
+                                    [--repeat 5]
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def define(n_families, n_workflows, n_states, n_transitions, n_calls, lazy, seed=0):
+    """ define the workflows and models, and return the time spent in each phase
+    """
+    from django.db import models
+    from kworkflows.workflow import KWorkFlow, KWorkFlowEnabled, StateField, transition
+
+    rnd = random.Random(seed)
+    names = ['state_{}'.format(i) for i in range(n_states)]
+    transition_names = ['trans_{}'.format(j) for j in range(n_transitions)]
+    timings = {}
+
+    def make_method(name):
+        def method(self, advance_state):
+            advance_state()
+        method.__name__ = name
+        return transition(method)
+
+    # generated beforehand, not to be timed
+    states = tuple((s, s.title()) for s in names)
+    definitions = [[tuple((tr, tuple(rnd.sample(names[:-1], rnd.randint(1, 3))), rnd.choice(names[1:]))
+                          for tr in transition_names) for w in range(n_workflows)] for f in range(n_families)]
+    methods = [{name: make_method(name) for name in transition_names} for w in range(n_workflows)]
+
+    start = time.perf_counter()
+    families = []
+    for f in range(n_families):
+        mother = KWorkFlow.factory('Family{}'.format(f), lazy=lazy)
+        workflows = [type('Family{}Workflow{}'.format(f, w), (mother,), {'states': states, 'transitions': transitions})
+                     for w, transitions in enumerate(definitions[f])]
+        families.append((mother, workflows))
+    timings['workflows'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for f, (mother, workflows) in enumerate(families):
+        model = type('Order{}'.format(f), (KWorkFlowEnabled,), {
+            '__module__': __name__,
+            'kind': models.IntegerField(),
+            'state': StateField(mother, choices=True),
+            'Meta': type('Meta', (), {'app_label': 'bench'}),
+        })
+        for w, wf in enumerate(workflows):
+            attrs = dict(methods[w])
+            attrs.update(__module__=__name__, workflow=wf, specific_fields={'kind': w},
+                         Meta=type('Meta', (), {'app_label': 'bench', 'proxy': True}))
+            type('Order{}Proxy{}'.format(f, w), (model,), attrs)
+    timings['models'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for mother, workflows in families:
+        for wf in workflows:
+            wf.advance_state(transition_names[0], wf._transitions[transition_names[0]][0][0])
+    timings['first_use'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for mother, workflows in families:
+        for _ in range(n_calls):
+            mother.get_aggregated_states(), mother.get_initial_state()
+    timings['cached'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for mother, workflows in families:
+        for _ in range(n_calls):
+            for name in ('_aggregated_states', '_common_initial_state'):  # as before caching: recomputed each call
+                delattr(mother, name)
+            mother.get_aggregated_states(), mother.get_initial_state()
+    timings['uncached'] = time.perf_counter() - start
+    return timings
+
+
+def child(args):
+    sys.path.insert(0, ROOT)
+    import django
+    from django.conf import settings
+    settings.configure(INSTALLED_APPS=['kworkflows'])
+    django.setup()
+    timings = define(args.families, args.workflows, args.states, args.transitions, args.calls, args.mode == 'lazy')
+    print(' '.join('{}={:.4f}'.format(k, v) for k, v in sorted(timings.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--families', type=int, default=10, help="number of mother workflow classes and models")
+    parser.add_argument('--workflows', type=int, default=30, help="specific workflows (and proxies) per family")
+    parser.add_argument('--states', type=int, default=20)
+    parser.add_argument('--transitions', type=int, default=30)
+    parser.add_argument('--calls', type=int, default=100, help="calls of the aggregated states per mother class")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--mode', choices=('eager', 'lazy'), help=argparse.SUPPRESS)  # child process
+    args = parser.parse_args()
+    if args.mode:
+        return child(args)
+    print("{} families x {} workflows and proxies, {} states, {} transitions".format(
+        args.families, args.workflows, args.states, args.transitions))
+    print("{:<6} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}".format(
+        'mode', 'workflows s', 'models s', 'startup s', 'first use s', 'cached s', 'uncached s'))
+    for mode in ('eager', 'lazy'):
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.check_output([sys.executable, __file__, '--mode', mode] + sys.argv[1:]).decode()
+            runs.append(dict((k, float(v)) for k, v in (item.split('=') for item in out.split())))
+        t = {k: min(r[k] for r in runs) for k in runs[0]}
+        print("{:<6} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.4f}".format(
+            mode, t['workflows'], t['models'], t['workflows'] + t['models'], t['first_use'], t['cached'],
+            t['uncached']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of KWorkFlow.advance_state on large generated workflows,
+compared to the former lookup (transition dict then linear scan of the 'from' states tuple).
+Usage: python benchmarks/transition_tables.py [--states 300] [--transitions 300] [--fan-in 50]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+settings.configure()
+django.setup()
+
+from kworkflows.constants import InvalidStateForTransition, InvalidTransitionName  # noqa: E402
+from kworkflows.workflow import KWorkFlow  # noqa: E402
+
+
+def make_workflow(n_states, n_transitions, fan_in, seed=0):
+    rnd = random.Random(seed)
+    states = tuple(('state_{}'.format(i), 'State {}'.format(i)) for i in range(n_states))
+    names = [s[0] for s in states]
+    transitions = tuple(('trans_{}'.format(j), tuple(rnd.sample(names, rnd.randint(1, fan_in))), rnd.choice(names))
+                        for j in range(n_transitions))
+    return type('BenchWorkflow', (KWorkFlow,), {'states': states, 'transitions': transitions})
+
+
+def legacy_advance_state(wf, transition, state):
+    try:
+        t = wf._transitions[transition]
+    except KeyError:
+        raise InvalidTransitionName(wf.__name__, transition)
+    if state in t[0]:
+        return t[1]
+    raise InvalidStateForTransition(wf.__name__, transition, state)
+
+
+def make_calls(wf, n, seed=1):
+    """ a mix of valid (state, transition) pairs, the last 'from' state of each transition being the worst case
+    """
+    rnd = random.Random(seed)
+    transitions = list(wf._transitions.items())
+    calls = []
+    for _ in range(n):
+        tr, (from_states, _) = rnd.choice(transitions)
+        calls.append((tr, from_states[-1] if rnd.random() < 0.5 else rnd.choice(from_states)))
+    return calls
+
+
+def run(n_states, n_transitions, fan_in, n_calls, repeat):
+    wf = make_workflow(n_states, n_transitions, fan_in)
+    calls = make_calls(wf, n_calls)
+    advance_state = wf.advance_state
+
+    def compiled():
+        for tr, state in calls:
+            advance_state(tr, state)
+
+    def legacy():
+        for tr, state in calls:
+            legacy_advance_state(wf, tr, state)
+
+    results = {}
+    for name, f in (('legacy', legacy), ('compiled', compiled)):
+        results[name] = min(timeit.repeat(f, number=1, repeat=repeat)) / n_calls * 1e9
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--states', type=int, default=300)
+    parser.add_argument('--transitions', type=int, default=300)
+    parser.add_argument('--fan-in', type=int, default=50, help="max number of 'from' states per transition")
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    results = run(args.states, args.transitions, args.fan_in, args.calls, args.repeat)
+    print("{} states, {} transitions, fan-in <= {}".format(args.states, args.transitions, args.fan_in))
+    for name, ns in results.items():
+        print("  {:<10} {:8.1f} ns/call".format(name, ns))
+    print("  speedup    {:8.2f}x".format(results['legacy'] / results['compiled']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 11:39
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0002_census'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='providerorder',
+            index_together=set([('operator', 'type', 'state')]),
+        ),
+    ]
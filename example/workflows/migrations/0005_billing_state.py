@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 11:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0004_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='providerorder',
+            name='billing_state',
+            field=models.CharField(choices=[('unbilled', 'Unbilled'), ('invoiced', 'Invoiced'), ('paid', 'Paid')], default='unbilled', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='providerorder',
+            name='billing_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
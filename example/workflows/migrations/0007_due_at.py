@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 11:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0006_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='providerorder',
+            name='due_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 12:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0007_due_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodedOrder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state_version', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('state', models.SmallIntegerField(choices=[(1, 'Start'), (2, 'State 1'), (3, 'State 2'), (4, 'End'), (5, 'State A'), (6, 'State B')], default=1)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='CodedOrderHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(auto_now=True)),
+                ('from_state', models.SmallIntegerField(default=1)),
+                ('to_state', models.SmallIntegerField(default=1)),
+                ('underlying', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='histories', to='workflows.CodedOrder')),
+            ],
+            options={
+                'ordering': ['timestamp'],
+                'get_latest_by': 'timestamp',
+                'abstract': False,
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='codedorderhistory',
+            index_together=set([('underlying', 'timestamp')]),
+        ),
+    ]
@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import functools
 
+from datetime import timedelta
 
 from django.db import models
 
 from . import constants, utils
-from kworkflows.workflow import (KWorkFlow, KWorkFlowEnabled, StateField, transition,
-                                 WorkFlowHistory, WorkflowEnabledManager)
+from kworkflows.workflow import (CachedLookup, KWorkFlow, KWorkFlowEnabled, StateField, transition,
+                                 WorkFlowCensus, WorkFlowHistory, WorkFlowOutbox, WorkflowEnabledManager)
 
 
 class Operator(models.Model):
@@ -20,7 +20,10 @@ class Operator(models.Model):
 
 
 # Define workflow mother class
-ProviderOrderWorkflow = KWorkFlow.factory('ProviderOrderWorkflow')
+# with optional states storage codes, used by coded StateFields
+ProviderOrderWorkflow = KWorkFlow.factory('ProviderOrderWorkflow', state_codes={
+    'start': 1, 'state_1': 2, 'state_2': 3, 'end': 4, 'state_a': 5, 'state_b': 6,
+})
 
 
 # Define workflow specific classes
@@ -37,6 +40,10 @@ class OVHModifyWorkflow(ProviderOrderWorkflow):
         ('trans_2', 'state_2', 'state_1'),
         ('finalize', ('state_1', 'state_2'), 'end'),
     )
+    # fire 'finalize' when an order stays in state_1 for 48 hours (see fire_timeouts)
+    timeouts = (
+        ('finalize', 'state_1', timedelta(hours=48)),
+    )
 
 
 class SFRModifyWorkflow(ProviderOrderWorkflow):
@@ -54,12 +61,38 @@ class SFRModifyWorkflow(ProviderOrderWorkflow):
     )
 
 
+# Define workflow of an additional state field (optional)
+# with its own states and transitions, independent of the main workflows
+class BillingWorkflow(KWorkFlow):
+    states = (
+        ('unbilled', 'Unbilled'),
+        ('invoiced', 'Invoiced'),
+        ('paid', 'Paid'),
+    )
+    transitions = (
+        ('invoice', 'unbilled', 'invoiced'),
+        ('pay', 'invoiced', 'paid'),
+    )
+
+
 # Define history class (optional)
 # with a single field = foreign key to underlying model
 class ProviderOrderHistory(WorkFlowHistory):
     underlying = models.ForeignKey('ProviderOrder', related_name='histories')
 
 
+# Define census class (optional)
+# maintaining the number of orders per workflow and state
+class ProviderOrderCensus(WorkFlowCensus):
+    pass
+
+
+# Define outbox class (optional)
+# recording each creation and transition for downstream consumers
+class ProviderOrderOutbox(WorkFlowOutbox):
+    pass
+
+
 # Define model with a 'state' field initialised with workflow mother class
 class ProviderOrder(KWorkFlowEnabled):
     uid = utils.UIDField()
@@ -68,18 +101,37 @@ class ProviderOrder(KWorkFlowEnabled):
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
     state = StateField(ProviderOrderWorkflow, choices=True)  # specify workflow mother class here
+    # additional state field, with its version counter 'billing_version' added to the model
+    billing_state = StateField(BillingWorkflow, choices=True, version_field='billing_version')
+    # time the state times out, maintained by transitions (optional)
+    due_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     objects = WorkflowEnabledManager()  # use this manager
     histo = ProviderOrderHistory
+    census = ProviderOrderCensus
+    census_shards = 2
+    outbox = ProviderOrderOutbox
+    timeout_field = 'due_at'
+
+    class Meta:
+        index_together = [('operator', 'type', 'state')]  # see get_suggested_indexes
 
     def __str__(self):
         return "{} on {}, state={}".format(self.uid, self.operator.name, self.state)
 
+    @transition(field='billing_state')
+    def invoice(self, advance_state):
+        advance_state()
+
+    @transition(field='billing_state', guard=~models.Q(state='start'))  # only submitted orders can be paid
+    def pay(self, advance_state):
+        advance_state()
+
 
 # Define proxy classes with specific workflows
 class OVHModifyOrder(ProviderOrder):
     specific_fields = {
-        'operator': functools.partial(Operator.objects.get, name='OVH'),
+        'operator': CachedLookup(Operator, id_only=True, name='OVH'),
         'type': constants.ORDER_TYPE.MODIFY
     }
     workflow = OVHModifyWorkflow   # specify workflow specific class here
@@ -106,7 +158,7 @@ class OVHModifyOrder(ProviderOrder):
 
 class SFRModifyOrder(ProviderOrder):
     specific_fields = {
-        'operator': functools.partial(Operator.objects.get, name='SFR'),
+        'operator': CachedLookup(Operator, id_only=True, name='SFR'),
         'type': constants.ORDER_TYPE.MODIFY
     }
     workflow = SFRModifyWorkflow   # specify workflow specific class here
@@ -129,3 +181,38 @@ class SFRModifyOrder(ProviderOrder):
     @transition
     def finalize(self, advance_state):
         advance_state()
+
+
+# Define history class with coded states (optional)
+class CodedOrderHistory(WorkFlowHistory):
+    underlying = models.ForeignKey('CodedOrder', related_name='histories')
+    from_state = StateField(ProviderOrderWorkflow, coded=True)
+    to_state = StateField(ProviderOrderWorkflow, coded=True)
+
+
+# Define model storing its states as small integers, with the codes of the mother class (optional)
+# and a specific workflow, without proxy classes
+class CodedOrder(KWorkFlowEnabled):
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+    state = StateField(ProviderOrderWorkflow, coded=True, choices=True)
+    workflow = OVHModifyWorkflow
+
+    objects = WorkflowEnabledManager()
+    histo = CodedOrderHistory
+
+    @transition
+    def submit(self, advance_state):
+        advance_state()
+
+    @transition
+    def trans_1(self, advance_state):
+        advance_state()
+
+    @transition
+    def trans_2(self, advance_state):
+        advance_state()
+
+    @transition
+    def finalize(self, advance_state):
+        advance_state()
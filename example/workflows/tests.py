@@ -1,9 +1,31 @@
+import gc
+import json
+import queue
+import tempfile
+
+from collections import Counter
 from datetime import timedelta
-from django.test import TestCase
+from io import StringIO
+from unittest import mock, skipIf
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, OperationalError, connection, connections, transaction
+from django.db.models import Count, F, Max, Q, QuerySet
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from mixer.backend.django import mixer
 
+from kworkflows import metrics, simulation
 from kworkflows.constants import *
+from kworkflows.executor import TransitionExecutor, worker_index
+from kworkflows.management.commands import reconcile_census
+from kworkflows.signals import post_transition, pre_transition
+from kworkflows.simulation import Simulation
+from kworkflows.workflow import (CachedLookup, HistoryBuffer, KWorkFlow, RetryPolicy, StateField, check_guard_lookups,
+                                 check_workflows, evaluate_guard, transition)
 
 from . import constants, models
 
@@ -21,6 +43,9 @@ class TestModels(TestCase):
         self.assertTrue(t-d < order.created_at < t+d)
         self.assertTrue(t-d < order.modified_at < t+d)
 
+    def test_check_workflows(self):
+        self.assertEqual(check_workflows(), [])
+
     def test_order_specific(self):
         models.Operator.objects.create(name='OVH')
         order = models.OVHModifyOrder.objects.create()
@@ -56,6 +81,23 @@ class TestModels(TestCase):
         self.assertEqual(order.state, 'state_1')
         self.assertGreater(order.modified_at, t)
 
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_order_safe_advance_state_no_refresh(self):
+        models.Operator.objects.create(name='OVH')
+        order = models.OVHModifyOrder.objects.create()
+        with self.assertNumQueries(2):  # update, history
+            order.safe_advance_state('submit')
+        self.assertEqual(order.state, 'state_1')
+        self.assertEqual(order.state_version, 1)
+        fresh = models.OVHModifyOrder.objects.get(pk=order.pk)
+        self.assertEqual((fresh.state, fresh.state_version, fresh.modified_at),
+                         (order.state, order.state_version, order.modified_at))
+        with self.assertNumQueries(3):  # update, reload, history
+            order.safe_advance_state('trans_1', refresh=True)
+        self.assertEqual(order.state, 'state_2')
+        self.assertEqual(order.state_version, 2)
+
     def test_order_invalid_transition(self):
         models.Operator.objects.create(name='OVH')
         order = models.OVHModifyOrder.objects.create()
@@ -125,3 +167,1221 @@ class TestTransition(TestCase):
         self.assertEqual(o2_last.from_state, 'state_a')
         self.assertEqual(o2_last.to_state, 'state_b')
         self.assertEqual(o2_last.underlying, o2)
+
+
+class TestBulkTransition(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def test_bulk_transition(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(5)]
+        orders[0].submit()
+        sfr = models.SFRModifyOrder.objects.create()
+        pks = models.OVHModifyOrder.objects.all().bulk_transition('submit')
+        self.assertEqual(set(pks), {o.pk for o in orders[1:]})
+        for o in orders:
+            o.refresh_from_db()
+            self.assertEqual(o.state, 'state_1')
+            self.assertEqual(o.state_version, 1)
+            self.assertEqual(o.histories.latest().to_state, 'state_1')
+            self.assertEqual(o.histories.count(), 2)
+        sfr.refresh_from_db()
+        self.assertEqual(sfr.state, 'start')
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_bulk_transition_several_from_states(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(3)]
+        models.OVHModifyOrder.objects.all().bulk_transition('submit')
+        models.OVHModifyOrder.objects.filter(pk=orders[0].pk).bulk_transition('trans_1')
+        with self.assertNumQueries(5):  # select, update, insert + savepoint and release
+            pks = models.OVHModifyOrder.objects.all().bulk_transition('finalize')
+        self.assertEqual(len(pks), 3)
+        self.assertEqual(sorted(h.from_state for h in models.ProviderOrderHistory.objects.filter(to_state='end')),
+                         ['state_1', 'state_1', 'state_2'])
+        self.assertEqual(models.OVHModifyOrder.objects.all().bulk_transition('finalize'), [])
+
+    def test_bulk_transition_invalid(self):
+        self.assertRaises(InvalidTransitionName, models.OVHModifyOrder.objects.all().bulk_transition, 'toto')
+        self.assertRaises(InvalidTransitionName, models.ProviderOrder.objects.all().bulk_transition, 'toto')
+
+    def test_bulk_transition_underlying_model(self):
+        ovh = [models.OVHModifyOrder.objects.create() for _ in range(2)]
+        sfr = models.SFRModifyOrder.objects.create()
+        pks = models.ProviderOrder.objects.exclude(pk=ovh[1].pk).bulk_transition('submit')
+        self.assertEqual(set(pks), {ovh[0].pk, sfr.pk})
+        self.assertEqual(list(models.ProviderOrder.objects.order_by('pk').values_list('state', flat=True)),
+                         ['state_1', 'start', 'state_a'])
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(from_state='start').count(), 2)
+        self.assertEqual(models.ProviderOrderCensus.objects.counts('SFRModifyWorkflow')['state_a'], 1)
+        self.assertEqual(models.ProviderOrderOutbox.objects.filter(transition='submit').count(), 2)
+        self.assertEqual(models.ProviderOrder.objects.all().bulk_transition('trans_1'), [ovh[0].pk])  # OVH only
+        self.assertEqual(set(models.ProviderOrder.objects.all().bulk_goto_state('end')), {o.pk for o in ovh + [sfr]})
+
+
+class TestBulkCreate(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_bulk_create(self):
+        with self.assertNumQueries(8):  # operator, savepoint, 2 x (insert, pks), history, release
+            orders = models.OVHModifyOrder.objects.bulk_create(
+                [models.OVHModifyOrder() for _ in range(3)], batch_size=2)
+        self.assertEqual(models.OVHModifyOrder.objects.count(), 3)
+        for order in orders:
+            self.assertTrue(order.pk)
+            self.assertEqual(order.operator.name, 'OVH')
+            self.assertEqual(order.type, constants.ORDER_TYPE.MODIFY)
+            self.assertEqual(order.state, 'start')
+            history = order.histories.get()
+            self.assertEqual((history.from_state, history.to_state), (CREATION_STATE, 'start'))
+        orders[0].submit()
+        self.assertEqual(orders[0].state, 'state_1')
+
+    def test_bulk_create_underlying_model(self):
+        ovh = models.Operator.objects.get(name='OVH')
+        sfr = models.Operator.objects.create(name='SFR')
+        modify = constants.ORDER_TYPE.MODIFY
+        orders = models.ProviderOrder.objects.bulk_create([
+            models.ProviderOrder(operator=ovh, type=modify), models.ProviderOrder(operator=sfr, type=modify),
+            models.ProviderOrder(operator=ovh, type=constants.ORDER_TYPE.ACTIVATE, state='end')])  # no workflow
+        self.assertTrue(all(type(order) is models.ProviderOrder for order in orders))
+        self.assertEqual(list(models.ProviderOrderHistory.objects.order_by('underlying').values_list(
+            'underlying', 'to_state')), [(orders[0].pk, 'start'), (orders[1].pk, 'start')])
+        self.assertEqual(models.ProviderOrderCensus.objects.counts(),
+                         {('OVHModifyWorkflow', 'start'): 1, ('SFRModifyWorkflow', 'start'): 1})
+        self.assertEqual(sorted(models.ProviderOrderOutbox.objects.values_list('object_pk', 'workflow')),
+                         [(str(orders[0].pk), 'OVHModifyWorkflow'), (str(orders[1].pk), 'SFRModifyWorkflow')])
+        order = models.ProviderOrder.objects.create(operator=sfr, type=modify)
+        generic = models.ProviderOrder.objects.create(operator=sfr, type=constants.ORDER_TYPE.ACTIVATE)
+        self.assertEqual(list(order.histories.values_list('to_state', flat=True)), ['start'])
+        self.assertFalse(generic.histories.exists())
+        self.assertEqual(models.ProviderOrderCensus.objects.counts('SFRModifyWorkflow'), {'start': 2})
+
+    def test_bulk_create_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(models.OVHModifyOrder.objects.bulk_create([]), [])
+
+
+class TestCachedLookup(TestCase):
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_cached_lookup(self):
+        ovh = models.Operator.objects.create(name='OVH')
+        lookup = models.OVHModifyOrder.specific_fields['operator']
+        with self.assertNumQueries(1):
+            self.assertEqual(models.OVHModifyOrder.get_specific_fields(),
+                             {'operator_id': ovh.pk, 'type': constants.ORDER_TYPE.MODIFY})
+            lookup()
+        with self.assertNumQueries(2):  # order and history inserts, no operator lookup
+            models.OVHModifyOrder.objects.create()
+        models.Operator.objects.filter(pk=ovh.pk).delete()
+        other = models.Operator.objects.create(name='OVH')  # invalidates cache
+        self.assertEqual(lookup(), other.pk)
+        lookup.invalidate()
+        with self.assertNumQueries(1):
+            self.assertEqual(lookup(), other.pk)
+
+    def test_cached_lookup_ttl(self):
+        ovh = models.Operator.objects.create(name='OVH')
+        lookup = CachedLookup(models.Operator, ttl=0, name='OVH')
+        self.assertEqual(lookup(), ovh)
+        with self.assertNumQueries(1):
+            self.assertEqual(lookup(), ovh)
+
+
+class TestWorkflow(TestCase):
+
+    def test_available_transitions(self):
+        wf = models.OVHModifyWorkflow
+        self.assertEqual(wf.available_transitions('state_1'), {'trans_1', 'finalize'})
+        self.assertEqual(wf.available_transitions('end'), set())
+        self.assertEqual(wf.available_transitions('toto'), set())
+        self.assertTrue(wf.is_available('finalize', 'state_2'))
+        self.assertFalse(wf.is_available('finalize', 'start'))
+        self.assertEqual(wf.advance_state('finalize', 'state_2'), 'end')
+        self.assertRaises(InvalidStateForTransition, wf.advance_state, 'finalize', 'toto')
+
+    def test_compile_checks(self):
+        with self.assertRaises(InconsistentStateList):
+            class Duplicated(KWorkFlow):
+                states = (('a', 'A'), ('a', 'A'))
+                transitions = ()
+        with self.assertRaises(InconsistentStateInTransition):
+            class BadStart(KWorkFlow):
+                states = (('a', 'A'), ('b', 'B'))
+                transitions = (('t', ('a', 'c'), 'b'),)
+        with self.assertRaises(InconsistentStateInTransition):
+            class BadFinal(KWorkFlow):
+                states = (('a', 'A'), ('b', 'B'))
+                transitions = (('t', 'a', 'c'),)
+
+    def test_aggregated_states_cache(self):
+        mother = KWorkFlow.factory('Mother')
+        type('First', (mother,), dict(states=(('a', 'A'), ('b', 'B')), transitions=()))
+        self.assertEqual(dict(mother.get_aggregated_states()), {'a': 'A', 'b': 'B'})
+        self.assertIs(mother.get_aggregated_states(), mother.get_aggregated_states())
+        self.assertEqual(mother.get_initial_state(), 'a')
+        type('Second', (mother,), dict(states=(('c', 'C'),), transitions=()))
+        self.assertEqual(dict(mother.get_aggregated_states()), {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertRaises(MultipleDifferentFirstStates, mother.get_initial_state)
+
+    def test_lazy_compile(self):
+        mother = KWorkFlow.factory('LazyMother', lazy=True)
+        wf = type('Lazy', (mother,), dict(states=(('a', 'A'), ('b', 'B')), transitions=(('t', 'a', 'b'),)))
+        self.assertNotIn('_table', wf.__dict__)
+        self.assertEqual(wf.advance_state('t', 'a'), 'b')  # compiled at first use
+        self.assertIn('_table', wf.__dict__)
+        sub = type('LazySub', (wf,), dict(states=(('a', 'A'), ('c', 'C')), transitions=(('t', 'a', 'c'),)))
+        self.assertEqual(sub.advance_state('t', 'a'), 'c')  # compiled at once, not to use the tables of wf
+        bad = type('LazyBad', (mother,), dict(states=(('a', 'A'),), transitions=(('t', 'a', 'c'),)))
+        self.assertRaises(AttributeError, getattr, mother, '_table')
+        errors = check_workflows()
+        self.assertEqual([(e.obj, e.id) for e in errors], [(bad, 'kworkflows.E001')])
+        self.assertRaises(InconsistentStateInTransition, bad.advance_state, 't', 'a')
+        del bad, errors
+        gc.collect()  # unregister the bad workflow
+        self.assertEqual(check_workflows(), [])
+
+
+class TestPolymorphic(TestCase):
+
+    def test_polymorphic(self):
+        generic = mixer.blend('workflows.providerorder')
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+        ovh = [models.OVHModifyOrder.objects.create() for _ in range(2)]
+        sfr = models.SFRModifyOrder.objects.create()
+        with self.assertNumQueries(1):
+            orders = {o.pk: o for o in models.ProviderOrder.objects.polymorphic()}
+        self.assertIs(type(orders[generic.pk]), models.ProviderOrder)
+        self.assertIs(type(orders[ovh[0].pk]), models.OVHModifyOrder)
+        self.assertIs(type(orders[ovh[1].pk]), models.OVHModifyOrder)
+        self.assertIs(type(orders[sfr.pk]), models.SFRModifyOrder)
+        orders[sfr.pk].submit()
+        self.assertEqual(orders[sfr.pk].state, 'state_a')
+        orders[ovh[0].pk].submit()
+        self.assertEqual(models.ProviderOrder.objects.get(pk=ovh[0].pk).state, 'state_1')
+
+    def test_polymorphic_proxy_index(self):
+        ovh = models.Operator.objects.create(name='OVH')
+        sfr = models.Operator.objects.create(name='SFR')
+        self.assertEqual(set(models.ProviderOrder.get_workflow_proxies()),
+                         {models.OVHModifyOrder, models.SFRModifyOrder})
+        self.assertEqual(models.ProviderOrder.get_proxy_index(),
+                         [(('operator_id', 'type'), {(ovh.pk, 'modify'): models.OVHModifyOrder,
+                                                     (sfr.pk, 'modify'): models.SFRModifyOrder})])
+
+    def test_polymorphic_missing_operator(self):
+        ovh = models.Operator.objects.create(name='OVH')  # no SFR operator: no object can be a SFRModifyOrder
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(2)]
+        orders[1].submit()
+        generic = mixer.blend('workflows.providerorder', operator=ovh, type='other')
+        self.assertEqual(models.ProviderOrder.get_proxy_index(),
+                         [(('operator_id', 'type'), {(ovh.pk, 'modify'): models.OVHModifyOrder})])
+        self.assertEqual([type(o) for o in models.ProviderOrder.objects.order_by('pk').polymorphic()],
+                         [models.OVHModifyOrder, models.OVHModifyOrder, models.ProviderOrder])
+        qs = models.ProviderOrder.objects.all()
+        self.assertEqual(list(qs.can_transition('submit').values_list('pk', flat=True)), [orders[0].pk])
+        self.assertEqual(list(qs.in_states('state_1').values_list('pk', flat=True)), [orders[1].pk])
+        self.assertEqual(list(qs.terminal().values_list('pk', flat=True)), [])
+        self.assertEqual(qs.bulk_transition('submit'), [orders[0].pk])
+        models.ProviderOrder.objects.filter(pk=orders[0].pk).update(due_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(qs.fire_timeouts(), {'fired': 1, 'failed': 0})
+        self.assertEqual(qs.remap_states(), (generic.pk, 0))
+        out = StringIO()
+        call_command('reconcile_census', 'workflows.ProviderOrder', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['0 counters to fix'])
+
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        self.order = models.OVHModifyOrder.objects.create()
+        self.order.submit()
+
+    def test_retry_on_conflict(self):
+        policy = RetryPolicy(max_attempts=3)
+        other = models.OVHModifyOrder.objects.get(pk=self.order.pk)
+        other.trans_1()
+        with mock.patch.object(models.OVHModifyOrder, 'retry_policy', policy):
+            self.order.finalize()  # first attempt conflicts, state is reloaded, second attempt succeeds
+        self.assertEqual(self.order.state, 'end')
+        self.assertEqual(self.order.state_version, 3)
+        self.assertEqual((policy.calls, policy.attempts, policy.conflicts, policy.exhausted), (1, 2, 1, 0))
+        self.assertEqual(self.order.histories.latest().from_state, 'state_2')
+
+    def test_retry_invalid_state(self):
+        other = models.OVHModifyOrder.objects.get(pk=self.order.pk)
+        other.finalize()
+        self.assertRaises(InvalidStateForTransition, self.order.trans_1)
+
+    def test_retry_exhausted(self):
+        policy = RetryPolicy(max_attempts=2, raise_on_exhaustion=True)
+        with mock.patch.object(models.OVHModifyOrder, 'try_advance_state', return_value=None), \
+                mock.patch.object(models.OVHModifyOrder, 'retry_policy', policy):
+            self.assertRaises(FailAdvanceState, self.order.trans_1)
+        self.assertEqual((policy.calls, policy.attempts, policy.conflicts, policy.exhausted), (1, 2, 2, 1))
+        policy = RetryPolicy(max_attempts=5, backoff=1, jitter=False, deadline=0.5)
+        with mock.patch.object(models.OVHModifyOrder, 'try_advance_state', return_value=None), \
+                mock.patch.object(models.OVHModifyOrder, 'retry_policy', policy):
+            self.assertIsNone(self.order.safe_advance_state('trans_1'))
+        self.assertEqual((policy.attempts, policy.exhausted), (1, 1))
+
+    def test_retry_delays(self):
+        policy = RetryPolicy(backoff=0.01, max_backoff=0.05, jitter=False)
+        self.assertEqual([policy.delay(n) for n in range(4)], [0.01, 0.02, 0.04, 0.05])
+        policy.jitter = True
+        self.assertTrue(0 <= policy.delay(3) <= 0.05)
+
+
+class TestPessimistic(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def test_pessimistic_transition(self):
+        order = models.OVHModifyOrder.objects.create()
+        order.submit()
+        stale = models.OVHModifyOrder.objects.get(pk=order.pk)
+        order.trans_1()
+        policy = RetryPolicy()
+        with mock.patch.object(models.OVHModifyOrder, 'concurrency', PESSIMISTIC), \
+                mock.patch.object(models.OVHModifyOrder, 'retry_policy', policy):
+            stale.finalize()  # state is reloaded under lock, no conflict
+            self.assertRaises(InvalidStateForTransition, order.trans_2)
+        self.assertEqual(stale.state, 'end')
+        self.assertEqual(order.state, 'end')
+        self.assertEqual((policy.attempts, policy.conflicts), (2, 0))
+
+    def test_claim(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(4)]
+        models.SFRModifyOrder.objects.create()
+        orders[1].submit()
+        with transaction.atomic():
+            claimed = models.OVHModifyOrder.objects.claim('start', 2)
+            self.assertEqual([o.pk for o in claimed], [orders[0].pk, orders[2].pk])
+            self.assertIs(type(claimed[0]), models.OVHModifyOrder)
+            claimed = models.ProviderOrder.objects.polymorphic().claim('start', 10)
+            self.assertEqual([type(o) for o in claimed], [models.OVHModifyOrder] * 3 + [models.SFRModifyOrder])
+
+
+class TestHistoryBuffer(TransactionTestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        self.order = models.OVHModifyOrder.objects.create()
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_buffer_outside_transaction(self):
+        with HistoryBuffer():
+            self.order.submit()
+            self.order.trans_1()
+            self.assertEqual(self.order.histories.count(), 1)
+            with self.assertNumQueries(2):
+                self.order.finalize()  # begin, update
+        self.assertEqual([h.to_state for h in self.order.histories.all()], ['start', 'state_1', 'state_2', 'end'])
+
+    def test_buffer_on_commit(self):
+        with transaction.atomic():
+            with HistoryBuffer():
+                self.order.submit()
+                try:
+                    with transaction.atomic():
+                        self.order.trans_1()
+                        raise DatabaseError
+                except DatabaseError:
+                    self.order.reload_state()
+                with transaction.atomic():
+                    self.order.finalize()
+            self.assertEqual(self.order.histories.count(), 1)
+        self.assertEqual([h.to_state for h in self.order.histories.all()], ['start', 'state_1', 'end'])
+
+    def test_buffer_rollback(self):
+        with self.assertRaises(DatabaseError), transaction.atomic(), HistoryBuffer():
+            self.order.submit()
+            raise DatabaseError
+        self.assertEqual(self.order.histories.count(), 1)
+        self.order.reload_state()
+        with HistoryBuffer():
+            try:
+                with transaction.atomic():
+                    self.order.submit()
+                    raise DatabaseError
+            except DatabaseError:
+                self.order.reload_state()
+            self.order.submit()
+        self.assertEqual([h.to_state for h in self.order.histories.all()], ['start', 'state_1'])
+
+    def test_buffer_flush_size(self):
+        with transaction.atomic(), HistoryBuffer(flush_size=2):
+            self.order.submit()
+            self.assertEqual(self.order.histories.count(), 1)
+            self.order.trans_1()
+            self.assertEqual(self.order.histories.count(), 3)
+            self.order.trans_2()
+        self.assertEqual(self.order.histories.count(), 4)
+
+    def test_buffer_flush_size_savepoints(self):
+        # each transition in its own savepoint, as in pessimistic mode or in the executor
+        with transaction.atomic(), HistoryBuffer(flush_size=2) as buffer:
+            self.order.submit()
+            for i in range(10):
+                with transaction.atomic():
+                    self.order.trans_2() if i % 2 else self.order.trans_1()
+                buffered = len(buffer.committed) + sum(len(records) for records, _ in buffer.groups.values())
+                self.assertLessEqual(buffered, 2)
+        self.assertEqual(self.order.histories.count(), 12)
+
+    def test_buffer_flush_nested_rollback(self):
+        with transaction.atomic(), HistoryBuffer(flush_size=2):
+            with transaction.atomic():
+                self.order.submit()
+            try:
+                with transaction.atomic():
+                    self.order.trans_1()  # flushes the submit record in this savepoint, rolled back with it
+                    self.assertEqual(self.order.histories.count(), 3)
+                    raise DatabaseError
+            except DatabaseError:
+                self.order.reload_state()
+            self.assertEqual(self.order.histories.count(), 1)
+            with transaction.atomic():
+                self.order.trans_1()
+        self.assertEqual([(h.from_state, h.to_state) for h in self.order.histories.order_by('pk')],
+                         [(CREATION_STATE, 'start'), ('start', 'state_1'), ('state_1', 'state_2')])
+        with HistoryBuffer(flush_size=2):  # the nested savepoint rolls back last, the records are written at exit
+            with transaction.atomic():
+                with transaction.atomic():
+                    self.order.finalize()
+                try:
+                    with transaction.atomic():
+                        models.OVHModifyOrder.objects.create()  # flushes the finalize record in this savepoint
+                        raise DatabaseError
+                except DatabaseError:
+                    pass
+        self.assertEqual(self.order.histories.order_by('pk').last().to_state, 'end')
+        self.assertEqual(models.ProviderOrderHistory.objects.count(), 4)
+
+
+class TestCodedStateField(TestCase):
+
+    def test_state_codes(self):
+        wf = models.ProviderOrderWorkflow
+        self.assertEqual(wf.get_state_codes(), {CREATION_STATE: 0, 'start': 1, 'state_1': 2, 'state_2': 3,
+                                                'end': 4, 'state_a': 5, 'state_b': 6})
+        with mock.patch.object(wf, 'state_codes', {'start': 1, 'state_1': 2, 'state_2': 3, 'end': 4, 'state_a': 8}):
+            self.assertRaises(MissingStateCodes, wf.get_state_codes)
+            self.assertEqual(wf.make_state_codes(), {'start': 1, 'state_1': 2, 'state_2': 3, 'end': 4,
+                                                     'state_a': 8, 'state_b': 9})
+        with mock.patch.object(wf, 'state_codes', dict(wf.state_codes, end=1)):
+            self.assertRaises(InconsistentStateCodes, wf.get_state_codes)
+
+    def test_coded_field(self):
+        field = StateField(models.ProviderOrderWorkflow, coded=True, choices=True)
+        field.set_attributes_from_name('state')
+        self.assertEqual(field.get_internal_type(), 'SmallIntegerField')
+        self.assertEqual(field.default, 'start')
+        self.assertEqual(field.get_prep_value('state_2'), 3)
+        self.assertEqual(field.get_prep_value(CREATION_STATE), 0)
+        self.assertEqual(field.decode_state(6, None, None, None), 'state_b')
+        self.assertEqual(field.to_python(4), 'end')
+        self.assertEqual(field.to_python('end'), 'end')
+        field.clean('state_a', None)
+        name, path, args, kwargs = field.deconstruct()
+        self.assertEqual(path, 'django.db.models.SmallIntegerField')
+        self.assertEqual(kwargs['default'], 1)
+        self.assertIn((5, 'State A'), kwargs['choices'])
+        self.assertEqual(field.clone().deconstruct()[1:], (path, args, kwargs))
+        self.assertEqual(models.ProviderOrder._meta.get_field('state').deconstruct()[1], 'django.db.models.CharField')
+
+    def test_coded_model(self):
+        orders = [models.CodedOrder.objects.create() for _ in range(3)]
+        self.assertEqual(orders[0].state, 'start')
+        orders[0].submit()
+        orders[1].submit()
+        orders[0].refresh_from_db()
+        self.assertEqual(orders[0].state, 'state_1')
+        qs = models.CodedOrder.objects.order_by('pk')
+        self.assertEqual(list(qs.extra(select={'code': 'state'}).values_list('code', flat=True)), [2, 2, 1])
+        self.assertEqual(list(qs.values_list('state', flat=True)), ['state_1', 'state_1', 'start'])
+        self.assertEqual(list(qs.filter(state__in=['state_1', 'end'])), orders[:2])
+        self.assertEqual(list(qs.in_states('start')), orders[2:])
+        self.assertEqual(qs.filter(pk=orders[1].pk).bulk_transition('trans_1'), [orders[1].pk])
+        self.assertEqual(qs.filter(pk=orders[2].pk).update(state='end'), 1)
+        self.assertEqual(list(qs.values_list('state', flat=True)), ['state_1', 'state_2', 'end'])
+        self.assertEqual(list(qs.filter(state='end')), orders[2:])
+
+    def test_converters(self):
+        # states stored by name are read without any per row conversion
+        self.assertEqual(models.ProviderOrder._meta.get_field('state').get_db_converters(connection), [])
+        field = models.CodedOrder._meta.get_field('state')
+        self.assertEqual(field.get_db_converters(connection), [field.decode_state])
+
+    def test_coded_history(self):
+        order = models.CodedOrder.objects.create()
+        order.submit()
+        order.trans_1()
+        history = models.CodedOrderHistory.objects.filter(underlying=order).order_by('pk')
+        self.assertEqual(list(history.values_list('from_state', 'to_state')),
+                         [(CREATION_STATE, 'start'), ('start', 'state_1'), ('state_1', 'state_2')])
+        self.assertEqual(list(history.extra(select={'code': 'to_state'}).values_list('code', flat=True)), [1, 2, 3])
+        self.assertEqual(history.filter(from_state__in=['start', 'state_1']).count(), 2)
+        order = models.CodedOrder.objects.with_last_transition().get(pk=order.pk)
+        self.assertEqual((order.last_from_state, order.last_to_state), ('state_1', 'state_2'))
+        order = models.CodedOrder.objects.with_state_as_of(timezone.now()).get(pk=order.pk)
+        self.assertEqual(order.state_as_of, 'state_2')
+
+
+class TestCensus(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def test_census(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(3)]
+        orders += models.OVHModifyOrder.objects.bulk_create([models.OVHModifyOrder() for _ in range(2)])
+        sfr = models.SFRModifyOrder.objects.create()
+        orders[0].submit()
+        orders[0].trans_1()
+        models.OVHModifyOrder.objects.filter(pk__in=[o.pk for o in orders[1:3]]).bulk_transition('submit')
+        sfr.submit()
+        census = models.ProviderOrderCensus.objects
+        self.assertEqual(census.counts('OVHModifyWorkflow'), {'start': 2, 'state_1': 2, 'state_2': 1})
+        self.assertEqual(census.counts(), {('OVHModifyWorkflow', 'start'): 2, ('OVHModifyWorkflow', 'state_1'): 2,
+                                           ('OVHModifyWorkflow', 'state_2'): 1, ('SFRModifyWorkflow', 'start'): 0,
+                                           ('SFRModifyWorkflow', 'state_a'): 1})
+        self.assertLessEqual(census.filter(workflow='OVHModifyWorkflow', state='start').count(), 2)
+
+    def test_reconcile_census(self):
+        for _ in range(3):
+            models.OVHModifyOrder.objects.create().submit()
+        models.SFRModifyOrder.objects.create()
+        mixer.blend('workflows.providerorder')  # no workflow
+        census = models.ProviderOrderCensus.objects
+        census.add('OVHModifyWorkflow', 'state_1', 2)
+        census.add('OVHModifyWorkflow', 'end', 1)
+        census.filter(workflow='SFRModifyWorkflow').delete()
+        out = StringIO()
+        call_command('reconcile_census', 'workflows.ProviderOrder', '--dry-run', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['OVHModifyWorkflow end: -1', 'OVHModifyWorkflow state_1: -2',
+                                                       'SFRModifyWorkflow start: +1', '3 counters to fix'])
+        call_command('reconcile_census', 'workflows.ProviderOrder', stdout=out)
+        self.assertEqual(census.counts(), {('OVHModifyWorkflow', 'start'): 0, ('OVHModifyWorkflow', 'state_1'): 3,
+                                           ('OVHModifyWorkflow', 'end'): 0, ('SFRModifyWorkflow', 'start'): 1})
+        self.assertRaises(CommandError, call_command, 'reconcile_census', 'workflows.Operator')
+
+    def test_reconcile_census_overlapping_proxies(self):
+        for _ in range(2):
+            models.OVHModifyOrder.objects.create().submit()
+        models.SFRModifyOrder.objects.create()
+        # every OVH order matches the less specific fields of SFRModifyOrder too: counted in OVHModifyOrder only
+        with mock.patch.object(models.SFRModifyOrder, 'specific_fields', {'type': constants.ORDER_TYPE.MODIFY}):
+            actual = reconcile_census.Command.count_states(models.ProviderOrder)
+            loaded = Counter((o.workflow.__name__, o.state) for o in models.ProviderOrder.objects.polymorphic())
+        self.assertEqual(actual, {('OVHModifyWorkflow', 'state_1'): 2, ('SFRModifyWorkflow', 'start'): 1})
+        self.assertEqual(actual, loaded)
+
+    def test_reconcile_census_locks_counters(self):
+        models.OVHModifyOrder.objects.create()
+        calls = []
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True,
+                               side_effect=lambda qs: calls.append(qs.model) or qs), \
+                mock.patch('kworkflows.management.commands.reconcile_census.Command.count_states',
+                           side_effect=lambda model: calls.append('count') or {}):
+            call_command('reconcile_census', 'workflows.ProviderOrder', '--dry-run', stdout=StringIO())
+        self.assertEqual(calls, [models.ProviderOrderCensus, 'count'])
+
+
+class TestWorkflowFilters(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+        self.ovh = [models.OVHModifyOrder.objects.create() for _ in range(4)]
+        self.sfr = [models.SFRModifyOrder.objects.create() for _ in range(3)]
+        self.generic = mixer.blend('workflows.providerorder')
+        for o in self.ovh[1:] + self.sfr[1:]:
+            o.submit()
+        self.ovh[2].trans_1()
+        self.ovh[3].finalize()
+        self.sfr[2].trans_a()
+
+    def pks(self, qs):
+        return {o.pk for o in qs}
+
+    def test_can_transition(self):
+        self.assertEqual(self.pks(models.OVHModifyOrder.objects.can_transition('finalize')),
+                         {self.ovh[1].pk, self.ovh[2].pk})
+        self.assertEqual(self.pks(models.ProviderOrder.objects.can_transition('finalize')),
+                         {self.ovh[1].pk, self.ovh[2].pk, self.sfr[2].pk})
+        self.assertEqual(self.pks(models.ProviderOrder.objects.can_transition('trans_a')), {self.sfr[1].pk})
+        self.assertEqual(self.pks(models.ProviderOrder.objects.filter(pk=self.sfr[0].pk).can_transition('submit')),
+                         {self.sfr[0].pk})
+        self.assertRaises(InvalidTransitionName, models.OVHModifyOrder.objects.can_transition, 'trans_a')
+        self.assertRaises(InvalidTransitionName, models.ProviderOrder.objects.can_transition, 'toto')
+        for o in models.ProviderOrder.objects.can_transition('finalize').polymorphic():
+            o.finalize()
+        self.assertEqual(models.ProviderOrder.objects.can_transition('finalize').count(), 0)
+
+    def test_in_states_terminal(self):
+        self.assertEqual(self.pks(models.ProviderOrder.objects.in_states('start')),
+                         {self.ovh[0].pk, self.sfr[0].pk})
+        self.assertEqual(self.pks(models.SFRModifyOrder.objects.in_states('start', 'state_1')), {self.sfr[0].pk})
+        self.assertEqual(self.pks(models.ProviderOrder.objects.in_states('toto')), set())
+        self.assertEqual(self.pks(models.ProviderOrder.objects.terminal()), {self.ovh[3].pk})
+
+    def test_suggested_indexes(self):
+        self.assertEqual(models.ProviderOrder.get_suggested_indexes(), [('operator', 'type', 'state')])
+        self.assertEqual(models.ProviderOrder._meta.index_together, (('operator', 'type', 'state'),))
+
+
+class TestGotoState(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def test_paths(self):
+        wf = models.SFRModifyWorkflow
+        self.assertEqual(wf.find_path('start', 'end'), (('submit', 'start', 'state_a'),
+                                                        ('trans_a', 'state_a', 'state_b'),
+                                                        ('finalize', 'state_b', 'end')))
+        self.assertEqual(wf.find_path('state_b', 'state_b'), ())
+        self.assertEqual(models.OVHModifyWorkflow.find_path('state_2', 'end'), (('finalize', 'state_2', 'end'),))
+        self.assertEqual(wf.reachable_states('state_a'), {'state_a', 'state_b', 'end'})
+        self.assertRaises(UnreachableState, wf.find_path, 'end', 'start')
+        self.assertRaises(UnreachableState, wf.find_path, 'start', 'state_1')
+
+    def test_paths_lazy(self):
+        wf = type('LazyPaths', (KWorkFlow,), {'states': (('a', 'A'), ('b', 'B'), ('c', 'C')),
+                                              'transitions': (('t', 'a', 'b'), ('u', 'b', 'c'))})
+        self.assertEqual(wf._paths, {})  # built at first use only
+        self.assertEqual(wf.find_path('a', 'c'), (('t', 'a', 'b'), ('u', 'b', 'c')))
+        self.assertEqual(set(wf._paths), {'a'})
+        self.assertEqual(wf.reachable_states('b'), {'b', 'c'})
+        self.assertEqual(set(wf._paths), {'a', 'b'})
+        self.assertEqual(wf.reachable_states('unknown'), frozenset())
+        self.assertEqual(set(wf._paths), {'a', 'b'})
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_goto_state(self):
+        order = models.SFRModifyOrder.objects.create()
+        with self.assertNumQueries(2):  # update, history
+            self.assertTrue(order.goto_state('end'))
+        self.assertEqual((order.state, order.state_version), ('end', 1))
+        order.refresh_from_db()
+        self.assertEqual((order.state, order.state_version), ('end', 1))
+        self.assertEqual([(h.from_state, h.to_state) for h in order.histories.order_by('pk')],
+                         [(CREATION_STATE, 'start'), ('start', 'state_a'), ('state_a', 'state_b'), ('state_b', 'end')])
+        with self.assertNumQueries(0):
+            self.assertTrue(order.goto_state('end'))
+        self.assertRaises(UnreachableState, order.goto_state, 'start')
+
+    def test_goto_state_conflict(self):
+        order = models.SFRModifyOrder.objects.create()
+        models.SFRModifyOrder.objects.get(pk=order.pk).submit()
+        self.assertTrue(order.goto_state('state_b'))
+        order.refresh_from_db()
+        self.assertEqual((order.state, order.state_version), ('state_b', 2))
+        self.assertEqual(order.histories.count(), 3)
+        self.assertEqual(models.ProviderOrderCensus.objects.counts('SFRModifyWorkflow'), {'start': 0, 'state_a': 0, 'state_b': 1})
+
+    def test_bulk_goto_state(self):
+        orders = [models.SFRModifyOrder.objects.create() for _ in range(4)]
+        orders[1].submit()
+        orders[2].goto_state('state_b')
+        orders[3].goto_state('end')
+        ovh = models.OVHModifyOrder.objects.create()
+        pks = models.SFRModifyOrder.objects.all().bulk_goto_state('end')
+        self.assertEqual(set(pks), {o.pk for o in orders[:3]})
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(underlying__in=pks).count(), 3 + 1 + 2 + 6)
+        for o in orders:
+            o.refresh_from_db()
+            self.assertEqual(o.state, 'end')
+        ovh.refresh_from_db()
+        self.assertEqual(ovh.state, 'start')
+        self.assertEqual(models.ProviderOrderCensus.objects.counts('SFRModifyWorkflow')['end'], 4)
+        self.assertRaises(UnreachableState, models.SFRModifyOrder.objects.all().bulk_goto_state, 'state_1')
+        self.assertRaises(UnreachableState, models.ProviderOrder.objects.all().bulk_goto_state, 'state_9')
+        self.assertEqual(models.ProviderOrder.objects.all().bulk_goto_state('end'), [ovh.pk])  # per proxy
+
+
+class TestHistoryHelpers(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='SFR')
+        self.orders = [models.SFRModifyOrder.objects.create() for _ in range(3)]
+        self.orders[1].submit()
+        self.orders[2].goto_state('end')
+        models.ProviderOrderHistory.objects.filter(underlying=self.orders[0]).delete()
+
+    def test_annotations(self):
+        with self.assertNumQueries(1):
+            orders = list(models.SFRModifyOrder.objects.with_history_count().with_last_transition().order_by('pk'))
+        self.assertEqual([o.history_count for o in orders], [0, 2, 4])
+        self.assertEqual([(o.last_from_state, o.last_to_state) for o in orders],
+                         [(None, None), ('start', 'state_a'), ('state_b', 'end')])
+        self.assertIsNone(orders[0].last_transition_at)
+        self.assertEqual(orders[2].last_transition_at, self.orders[2].histories.latest().timestamp)
+        with mock.patch.object(models.ProviderOrder, 'histo', None):
+            self.assertRaises(MissingHistory, models.SFRModifyOrder.objects.with_history_count)
+
+    def test_prefetch(self):
+        with self.assertNumQueries(2):
+            orders = list(models.SFRModifyOrder.objects.prefetch_histories(last=2).order_by('pk'))
+            self.assertEqual([[(h.from_state, h.to_state) for h in o.last_histories] for o in orders],
+                             [[], [('start', 'state_a'), (CREATION_STATE, 'start')],
+                              [('state_b', 'end'), ('state_a', 'state_b')]])
+        with self.assertNumQueries(2):
+            orders = list(models.SFRModifyOrder.objects.prefetch_histories(to_attr='all_histories').order_by('pk'))
+            self.assertEqual([len(o.all_histories) for o in orders], [0, 2, 4])
+
+    def test_state_as_of(self):
+        day = timezone.now() - timedelta(days=10)
+        for order in self.orders[1:]:  # the n-th record of each order is dated day + n
+            for n, h in enumerate(order.histories.order_by('pk')):
+                models.ProviderOrderHistory.objects.filter(pk=h.pk).update(timestamp=day + timedelta(days=n))
+        order = self.orders[2]
+        self.assertIsNone(order.state_as_of(day - timedelta(hours=1)))
+        self.assertEqual(order.state_as_of(day), 'start')
+        self.assertEqual(order.state_as_of(day + timedelta(days=2, hours=1)), 'state_b')
+        self.assertEqual(order.state_as_of(timezone.now()), 'end')
+        as_of = day + timedelta(days=1, hours=1)
+        with self.assertNumQueries(1):
+            states = list(models.SFRModifyOrder.objects.with_state_as_of(as_of).order_by('pk')
+                          .values_list('state_as_of', flat=True))
+        self.assertEqual(states, [None, 'state_a', 'state_a'])
+        counts = models.SFRModifyOrder.objects.with_state_as_of(as_of, name='s').values('s').annotate(n=Count('pk'))
+        self.assertEqual({c['s']: c['n'] for c in counts}, {None: 1, 'state_a': 2})
+
+
+class TestTimeouts(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def test_compile(self):
+        self.assertEqual(models.OVHModifyWorkflow._timeouts, {'state_1': ('finalize', timedelta(hours=48))})
+        self.assertEqual(models.SFRModifyWorkflow._timeouts, {})
+        now = timezone.now()
+        self.assertEqual(models.OVHModifyWorkflow.due_at('state_1', now), now + timedelta(hours=48))
+        self.assertIsNone(models.OVHModifyWorkflow.due_at('state_2', now))
+
+    def test_bad_timeouts(self):
+        hour = timedelta(hours=1)
+        for timeouts, message in [((('t', 'b', hour),), "timeout transition t is not available from state b"),
+                                  ((('x', 'a', hour),), "timeout transition x is not available from state a"),
+                                  ((('t', 'c', hour),), "timeout for unknown state c"),
+                                  ((('t', 'a', hour), ('t', 'a', 2 * hour)), "several timeouts for state a")]:
+            with self.assertRaisesMessage(ImproperlyConfigured, message):
+                type('BadTimeouts', (KWorkFlow,), {'states': (('a', 'A'), ('b', 'B')),
+                                                   'transitions': (('t', 'a', 'b'),), 'timeouts': timeouts})
+
+    def test_due_at(self):
+        order = models.OVHModifyOrder.objects.create()
+        self.assertIsNone(order.due_at)
+        order.submit()
+        self.assertAlmostEqual(order.due_at, timezone.now() + timedelta(hours=48), delta=timedelta(seconds=5))
+        order.refresh_from_db()
+        self.assertIsNotNone(order.due_at)
+        order.trans_1()
+        order.refresh_from_db()
+        self.assertIsNone(order.due_at)
+        orders = models.OVHModifyOrder.objects.bulk_create([models.OVHModifyOrder() for _ in range(2)])
+        models.OVHModifyOrder.objects.filter(pk=orders[0].pk).bulk_transition('submit')
+        orders[1].goto_state('state_1')
+        self.assertEqual(models.ProviderOrder.objects.filter(due_at__isnull=False).count(), 2)
+        self.assertEqual(models.ProviderOrder.objects.due(timezone.now() + timedelta(days=3)).count(), 2)
+        self.assertEqual(models.ProviderOrder.objects.due().count(), 0)
+
+    def test_fire_timeouts(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(4)]
+        for order in orders[:3]:
+            order.submit()
+        orders[2].trans_1()
+        past = timezone.now() - timedelta(hours=1)
+        models.ProviderOrder.objects.filter(pk__in=[o.pk for o in orders[:3]]).update(due_at=past)  # 2 is stale
+        with self.assertLogs('kworkflows.workflow', 'ERROR'):
+            stats = models.ProviderOrder.objects.all().fire_timeouts(batch_size=1)
+        self.assertEqual(stats, {'fired': 2, 'failed': 1})
+        self.assertEqual(list(models.ProviderOrder.objects.order_by('pk').values_list('state', 'due_at')),
+                         [('end', None), ('end', None), ('state_2', past), ('start', None)])
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(to_state='end').count(), 2)
+        out = StringIO()
+        with self.assertLogs('kworkflows.workflow', 'ERROR'):
+            call_command('fire_timeouts', 'workflows.ProviderOrder', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "0 fired, 1 failed")
+        self.assertRaises(CommandError, call_command, 'fire_timeouts', 'workflows.Operator')
+
+    def test_fire_timeouts_keyset(self):
+        orders = [models.OVHModifyOrder.objects.create() for _ in range(5)]
+        for order in orders:
+            order.submit()
+        past = timezone.now() - timedelta(hours=1)
+        models.ProviderOrder.objects.update(due_at=past)  # same due time: pages continue on the pk
+        models.ProviderOrder.objects.filter(pk=orders[0].pk).update(due_at=past - timedelta(hours=1), state='end')
+        with self.assertLogs('kworkflows.workflow', 'ERROR'), CaptureQueriesContext(connection) as queries:
+            stats = models.ProviderOrder.objects.all().fire_timeouts(batch_size=2)
+        self.assertEqual(stats, {'fired': 4, 'failed': 1})
+        self.assertEqual(models.ProviderOrder.objects.filter(state='end').count(), 5)
+        claims = [q['sql'] for q in queries if '"due_at" <=' in q['sql']]
+        self.assertEqual(len(claims), 3)
+        self.assertTrue(all(' IN ' not in sql for sql in claims))  # no growing list of handled pks
+
+
+class TestRemapStates(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+        self.orders = [models.OVHModifyOrder.objects.create() for _ in range(5)]
+        self.orders.append(models.SFRModifyOrder.objects.create())
+        pks = [o.pk for o in self.orders[:4]] + [self.orders[5].pk]
+        # orders left in a state since renamed
+        models.ProviderOrder.objects.filter(pk__in=pks).update(state='legacy')
+        models.ProviderOrderHistory.objects.filter(underlying__in=pks).update(to_state='legacy')
+
+    def test_compile(self):
+        with self.assertRaises(InvalidStateRemap):
+            type('BadRemap', (KWorkFlow,), {'states': (('a', 'A'), ('b', 'B')), 'transitions': (('t', 'a', 'b'),),
+                                            'state_remap': {'c': 'd'}})
+
+    @mock.patch.object(models.OVHModifyWorkflow, 'state_remap', {'legacy': 'state_1'})
+    def test_remap_states(self):
+        qs = models.ProviderOrder.objects.all()
+        self.assertEqual(qs.remap_states(limit=3), (self.orders[2].pk, 3))
+        self.assertEqual(qs.remap_states(self.orders[2].pk, limit=3), (self.orders[5].pk, 1))
+        self.assertEqual(qs.remap_states(self.orders[5].pk), (None, 0))
+        self.assertEqual(list(models.ProviderOrder.objects.order_by('pk').values_list('state', 'state_version')),
+                         [('state_1', 1)] * 4 + [('start', 0), ('legacy', 0)])
+        self.assertEqual(models.ProviderOrderCensus.objects.counts('OVHModifyWorkflow')['state_1'], 4)
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(to_state='legacy').count(), 5)
+        last = models.ProviderOrderHistory.objects.get(underlying=self.orders[5]).pk
+        self.assertEqual(qs.remap_histories(), (last, 4))
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(to_state='state_1').count(), 4)
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(to_state='legacy').count(), 1)
+        order = models.OVHModifyOrder.objects.get(pk=self.orders[0].pk)
+        order.finalize()
+        self.assertEqual(order.state, 'end')
+
+    @mock.patch.object(models.OVHModifyWorkflow, 'state_remap', {'legacy': 'state_1'})
+    def test_remap_histories(self):
+        order = self.orders[4]  # left the legacy state before the remap
+        models.ProviderOrder.objects.filter(pk=order.pk).update(state='end')
+        left = models.ProviderOrderHistory.objects.create(underlying=order, from_state='legacy', to_state='end')
+        qs = models.ProviderOrder.objects.all()
+        self.assertEqual(qs.remap_states(), (self.orders[5].pk, 4))
+        self.assertEqual(models.ProviderOrderHistory.objects.get(pk=left.pk).from_state, 'legacy')
+        pks = list(models.ProviderOrderHistory.objects.exclude(underlying=order).order_by('pk')
+                   .values_list('pk', flat=True)) + [left.pk]
+        self.assertEqual(qs.remap_histories(limit=3), (pks[2], 3))
+        self.assertEqual(qs.remap_histories(pks[2], limit=3), (left.pk, 2))  # the SFR record is not remapped
+        self.assertEqual(qs.remap_histories(left.pk), (None, 0))
+        self.assertEqual(list(order.histories.order_by('pk').values_list('from_state', 'to_state')),
+                         [(CREATION_STATE, 'start'), ('state_1', 'end')])
+        self.assertEqual(list(models.ProviderOrderHistory.objects.filter(to_state='legacy')
+                              .values_list('underlying', flat=True)), [self.orders[5].pk])
+
+    @mock.patch.object(models.OVHModifyWorkflow, 'state_remap', {'legacy': 'state_1'})
+    def test_command(self):
+        histories = list(models.ProviderOrderHistory.objects.filter(to_state='legacy').order_by('pk')
+                         .values_list('pk', flat=True))
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = tmp + '/checkpoint.json'
+            out = StringIO()
+            call_command('remap_states', 'workflows.ProviderOrder', chunk_size=2, checkpoint=checkpoint, stdout=out)
+            self.assertEqual(out.getvalue().splitlines(), [
+                "2/4 objects remapped, last pk {}".format(self.orders[1].pk),
+                "4/4 objects remapped, last pk {}".format(self.orders[3].pk),
+                "4/4 objects remapped, last pk {}".format(self.orders[5].pk),
+                "4 objects remapped",
+                "2 history records remapped, last pk {}".format(histories[1]),
+                "4 history records remapped, last pk {}".format(histories[3]),
+                "4 history records remapped, last pk {}".format(histories[4]),
+                "4 history records remapped",
+            ])
+            out = StringIO()
+            call_command('remap_states', 'workflows.ProviderOrder', checkpoint=checkpoint, stdout=out)
+            self.assertEqual(out.getvalue().splitlines(), [
+                "Resuming history records after pk {}".format(histories[4]), "0 history records remapped"])
+        self.assertEqual(models.ProviderOrder.objects.filter(state='state_1').count(), 4)
+        self.assertEqual(models.ProviderOrderHistory.objects.filter(to_state='state_1').count(), 4)
+
+
+@skipIf(simulation.np is None, "numpy is not installed")
+class TestSimulation(TestCase):
+
+    def test_deterministic_path(self):
+        sim = Simulation(models.SFRModifyWorkflow, probabilities={'trans_b': 0},
+                         latencies={'submit': 1, 'trans_a': 2, 'finalize': 3}, seed=0)
+        result = sim.run(20000, horizon=100, points=10, batch_size=7000)
+        self.assertEqual(result.transitions, {'submit': 1, 'trans_a': 1, 'trans_b': 0, 'finalize': 1})
+        self.assertEqual(result.terminated, 1)
+        self.assertAlmostEqual(result.percentiles((50,))[50], 5.4, delta=0.3)  # median of a sum of exponentials
+        self.assertAlmostEqual(sum(result.time_in_state.values()), 6, delta=0.2)
+        self.assertEqual(result.occupancy['start'][0], 20000)
+        self.assertEqual(result.occupancy['end'][-1], 20000)
+        self.assertTrue(all(sum(v[i] for v in result.occupancy.values()) == 20000 for i in range(11)))
+        rates = result.rates(10)
+        self.assertEqual((rates['updates'], rates['history_writes']), (30, 40))
+        self.assertAlmostEqual(rates['in_flight']['state_b'], 30, delta=1)
+        self.assertIn("at 10 creations/s: 30.0 updates/s, 40.0 history writes/s", result.report(arrival_rate=10))
+
+    def test_timeouts(self):
+        # state_1 is only left by its timeout
+        sim = Simulation(models.OVHModifyWorkflow, probabilities={'finalize': 0, 'trans_1': 0}, seed=0)
+        result = sim.run(1000, horizon=3 * 86400)
+        self.assertEqual((result.transitions['finalize'], result.transitions['trans_1']), (1, 0))
+        self.assertAlmostEqual(result.percentiles((50,))[50], 48 * 3600 + 0.7, delta=0.2)
+        self.assertEqual(result.occupancy['end'][-1], 1000)
+
+
+class TestGuards(TestCase):
+
+    def setUp(self):
+        self.operator = models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+        self.orders = [models.OVHModifyOrder.objects.create() for _ in range(3)]
+        for order in self.orders:
+            order.submit()
+        models.ProviderOrder.objects.filter(pk=self.orders[0].pk).update(billing_state='paid')
+        self.orders[0].refresh_from_db()
+
+    def test_evaluate_guard(self):
+        order = self.orders[0]
+        self.assertTrue(evaluate_guard(Q(state='state_1', billing_state__in=['invoiced', 'paid']), order))
+        self.assertTrue(evaluate_guard(Q(state='start') | ~Q(billing_state='unbilled'), order))
+        self.assertFalse(evaluate_guard(Q(state_version__gt=1) | Q(created_at__gt=F('modified_at')), order))
+        with self.assertNumQueries(0):
+            self.assertTrue(evaluate_guard(Q(operator=self.operator, due_at__isnull=False), order))
+        self.assertTrue(evaluate_guard(Q(operator__name__startswith='OV'), order))
+        self.assertFalse(evaluate_guard(Q(due_at__lt=timezone.now()), order))  # no sql comparison with null
+        self.assertEqual(models.ProviderOrder.objects.filter(due_at__lt=timezone.now()).count(), 0)
+
+    def test_unsupported_lookups(self):
+        order = self.orders[0]
+        for guard in (Q(created_at__year=2020), Q(state__regex='^state'), Q(operator__name__iregex='ovh')):
+            models.ProviderOrder.objects.filter(guard).count()  # valid in the database
+            self.assertRaises(ImproperlyConfigured, check_guard_lookups, guard, models.ProviderOrder)
+            self.assertRaises(ImproperlyConfigured, evaluate_guard, guard, order)
+        self.assertRaises(ImproperlyConfigured, check_guard_lookups, Q(unknown=1), models.ProviderOrder)
+        check_guard_lookups(Q(operator__name__startswith='OV') | ~Q(pk__in=[1], due_at__isnull=True),
+                            models.ProviderOrder)
+        try:
+            with self.assertRaises(ImproperlyConfigured):  # at declaration
+                type('YearGuardOrder', (models.ProviderOrder,), {
+                    '__module__': models.__name__, 'Meta': type('Meta', (), {'proxy': True}),
+                    'pay': transition(lambda self, advance_state: advance_state(), field='billing_state',
+                                      guard=Q(created_at__year=2020)),
+                })
+        finally:
+            apps.all_models['workflows'].pop('yearguardorder', None)
+            apps.clear_cache()
+
+    @mock.patch.object(models.OVHModifyOrder.finalize, 'guard', Q(billing_state='paid'))
+    def test_filters(self):
+        self.assertEqual(list(models.OVHModifyOrder.objects.can_transition('finalize')), [self.orders[0]])
+        self.assertEqual(list(models.ProviderOrder.objects.can_transition('finalize')), [self.orders[0]])
+        self.assertEqual(models.OVHModifyOrder.objects.all().bulk_transition('finalize'), [self.orders[0].pk])
+        self.assertEqual(models.OVHModifyOrder.objects.all().bulk_goto_state('end'), [])
+
+    @mock.patch.object(models.OVHModifyOrder.finalize, 'guard', Q(billing_state='paid'))
+    def test_transition(self):
+        order = self.orders[1]
+        self.assertFalse(order.check_guard('finalize'))
+        with self.assertNumQueries(0):
+            self.assertRaises(GuardFailed, order.finalize)
+        order.billing_state = 'paid'  # in memory only: rejected by the update
+        self.assertRaises(GuardFailed, order.finalize)
+        self.assertRaises(GuardFailed, self.orders[2].goto_state, 'end')
+        self.assertEqual(models.ProviderOrder.objects.filter(state='end').count(), 0)
+        self.orders[0].finalize()
+        self.orders[0].refresh_from_db()
+        self.assertEqual(self.orders[0].state, 'end')
+
+    def test_example_guard(self):
+        order = models.OVHModifyOrder.objects.create()
+        self.assertFalse(order.check_guard('pay'))
+        order.invoice()
+        self.assertRaises(GuardFailed, order.pay)
+        self.orders[1].invoice()
+        self.orders[1].pay()
+        self.assertEqual(self.orders[1].billing_state, 'paid')
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        self.order = models.OVHModifyOrder.objects.create()
+
+    def test_signals(self):
+        received = []
+        receiver = lambda signal, sender, **kwargs: received.append((signal, sender, kwargs))
+        pre_transition.connect(receiver, sender=models.OVHModifyOrder)
+        post_transition.connect(receiver, sender=models.OVHModifyOrder)
+        self.addCleanup(pre_transition.disconnect, receiver, sender=models.OVHModifyOrder)
+        self.addCleanup(post_transition.disconnect, receiver, sender=models.OVHModifyOrder)
+        self.order.submit()
+        self.assertEqual(received, [
+            (pre_transition, models.OVHModifyOrder,
+             dict(instance=self.order, transition='submit', field='state', from_state='start')),
+            (post_transition, models.OVHModifyOrder,
+             dict(instance=self.order, transition='submit', field='state', from_state='start', to_state='state_1',
+                  result=None)),
+        ])
+        self.assertRaises(InvalidStateForTransition, self.order.submit)
+        self.assertEqual(len(received), 3)  # no post_transition signal
+
+    def test_disabled(self):
+        self.assertIsNone(metrics.backend)
+        self.assertIs(metrics.measure('transition', None), metrics.null_context)
+        self.assertIs(metrics.db_time(), metrics.null_context)
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_metrics(self):
+        stats = metrics.enable()
+        self.addCleanup(metrics.disable)
+        tags = dict(workflow='OVHModifyWorkflow', transition='submit')
+        self.order.submit()
+        self.assertEqual(stats.get('transition.calls', **tags), 1)
+        self.assertEqual(stats.get('transition.queries', **tags), 2)  # update, history
+        timings = {name: stats.timing_stats('transition.' + name, **tags) for name in ('time', 'db_time', 'body_time')}
+        self.assertEqual({t['count'] for t in timings.values()}, {1})
+        self.assertAlmostEqual(timings['time']['total'], timings['db_time']['total'] + timings['body_time']['total'])
+        self.assertGreater(timings['db_time']['total'], 0)
+        self.assertEqual(stats.timing_stats('history.time', workflow='OVHModifyWorkflow')['count'], 1)
+        self.assertRaises(InvalidStateForTransition, self.order.submit)
+        self.assertEqual(stats.get('transition.errors', **tags), 1)
+        # conflict: the order went back and forth meanwhile
+        other = models.OVHModifyOrder.objects.get(pk=self.order.pk)
+        other.trans_1()
+        other.trans_2()
+        self.order.finalize()
+        self.assertEqual(stats.get('advance.conflicts', workflow='OVHModifyWorkflow', transition='finalize'), 1)
+        self.assertEqual(stats.get('advance.retries', workflow='OVHModifyWorkflow', transition='finalize'), 1)
+        models.OVHModifyOrder.objects.create()
+        self.assertEqual(stats.get('create.calls', workflow='OVHModifyWorkflow'), 1)
+        self.assertEqual(stats.get('create.queries', workflow='OVHModifyWorkflow'), 2)  # insert, history
+        self.assertIn(('transition.calls', tags, 1), stats.report())
+
+    @mock.patch.object(models.ProviderOrder, 'retry_policy', RetryPolicy(backoff=0.1, jitter=False))
+    def test_metrics_backoff(self):
+        stats = metrics.enable()
+        self.addCleanup(metrics.disable)
+        self.order.submit()
+        other = models.OVHModifyOrder.objects.get(pk=self.order.pk)
+        other.trans_1()
+        other.trans_2()
+        self.order.finalize()  # conflict, then retry after sleeping 0.1s
+        self.assertEqual(self.order.state, 'end')
+        timings = {name: stats.timing_stats('transition.' + name, workflow='OVHModifyWorkflow', transition='finalize')
+                   for name in ('time', 'db_time', 'body_time')}
+        self.assertGreaterEqual(timings['time']['total'], 0.1)
+        self.assertLess(timings['db_time']['total'], 0.1)  # the sleep is not database time
+        self.assertGreaterEqual(timings['body_time']['total'], 0.1)
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+
+    def events(self, after=0):
+        return [(e.object_pk, e.transition, e.from_state, e.to_state)
+                for e in models.ProviderOrderOutbox.objects.read(after, limit=100)]
+
+    def test_outbox(self):
+        outbox = models.ProviderOrderOutbox.objects
+        self.assertEqual(outbox.last_id(), 0)
+        order = models.OVHModifyOrder.objects.create()
+        pk = str(order.pk)
+        order.submit()
+        cursor = outbox.last_id()
+        order.finalize()
+        self.assertEqual(self.events(), [(pk, '', CREATION_STATE, 'start'), (pk, 'submit', 'start', 'state_1'),
+                                         (pk, 'finalize', 'state_1', 'end')])
+        self.assertEqual(self.events(cursor), [(pk, 'finalize', 'state_1', 'end')])
+        event = outbox.read(cursor)[0]
+        self.assertEqual((event.model, event.workflow), ('workflows.ProviderOrder', 'OVHModifyWorkflow'))
+        self.assertEqual(outbox.read(limit=2), outbox.read()[:2])
+        self.assertEqual(outbox.read(lag=60), [])
+        self.assertEqual(outbox.prune(), 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(outbox.prune(up_to=cursor), 2)
+        self.assertEqual(self.events(), [(pk, 'finalize', 'state_1', 'end')])
+        self.assertEqual(outbox.prune(older_than=timedelta(hours=1)), 0)
+        self.assertEqual(outbox.prune(older_than=timedelta(0)), 1)
+
+    def test_outbox_rollback(self):
+        order = models.OVHModifyOrder.objects.create()
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            order.submit()
+            raise DatabaseError
+        self.assertEqual(len(self.events()), 1)
+
+    def test_outbox_bulk(self):
+        orders = models.SFRModifyOrder.objects.bulk_create([models.SFRModifyOrder() for _ in range(3)])
+        cursor = models.ProviderOrderOutbox.objects.last_id()
+        models.SFRModifyOrder.objects.filter(pk=orders[0].pk).bulk_transition('submit')
+        models.SFRModifyOrder.objects.all().bulk_goto_state('state_b')
+        orders[1].goto_state('end')
+        pks = [str(o.pk) for o in orders]
+        events = self.events(cursor)
+        self.assertEqual(len(events), 1 + 5 + 1)
+        self.assertEqual([e for e in events if e[0] == pks[1]], [
+            (pks[1], 'submit', 'start', 'state_a'),
+            (pks[1], 'trans_a', 'state_a', 'state_b'),
+            (pks[1], 'finalize', 'state_b', 'end'),  # after a conflict, from the reloaded state
+        ])
+
+
+class TestStateFields(TestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        self.order = models.OVHModifyOrder.objects.create()
+
+    def test_fields(self):
+        self.assertEqual(models.ProviderOrder.get_state_fields(), ['state', 'billing_state'])
+        self.assertEqual(models.ProviderOrder.get_version_field('billing_state'), 'billing_version')
+        self.assertEqual(set(models.ProviderOrder.get_transitions_methods('billing_state')), {'invoice', 'pay'})
+        self.assertNotIn('invoice', models.OVHModifyOrder.get_transitions_methods())
+        self.assertEqual((self.order.billing_state, self.order.billing_version), ('unbilled', 0))
+        self.assertIs(self.order.get_state_workflow('billing_state'), models.BillingWorkflow)
+
+    def test_independent_versions(self):
+        stale = models.OVHModifyOrder.objects.get(pk=self.order.pk)
+        self.order.submit()
+        with mock.patch.object(models.OVHModifyOrder, 'reload_state') as reload_state:
+            stale.invoice()  # no conflict with the transition of the other field
+        reload_state.assert_not_called()
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.state, self.order.state_version), ('state_1', 1))
+        self.assertEqual((self.order.billing_state, self.order.billing_version), ('invoiced', 1))
+        self.assertEqual(self.order.histories.count(), 2)  # history of 'state' only
+        self.assertRaises(InvalidTransitionName, self.order.safe_advance_state, 'submit', field='billing_state')
+
+    @mock.patch.object(models.ProviderOrder, 'census', None)
+    @mock.patch.object(models.ProviderOrder, 'outbox', None)
+    def test_advance_states(self):
+        with self.assertNumQueries(2):  # update, history
+            self.assertTrue(self.order.safe_advance_states(state='submit', billing_state='invoice'))
+        self.assertEqual((self.order.state, self.order.billing_state), ('state_1', 'invoiced'))
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.state, self.order.state_version), ('state_1', 1))
+        self.assertEqual((self.order.billing_state, self.order.billing_version), ('invoiced', 1))
+        # conflict on one field: both fields are reloaded and both transitions retried
+        models.OVHModifyOrder.objects.get(pk=self.order.pk).pay()
+        self.assertRaises(InvalidStateForTransition, self.order.safe_advance_states,
+                          state='finalize', billing_state='pay')
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.state, self.order.billing_state), ('state_1', 'paid'))
+
+
+class TestExecutor(TransactionTestCase):
+
+    def setUp(self):
+        models.Operator.objects.create(name='OVH')
+        models.Operator.objects.create(name='SFR')
+        self.ovh = [models.OVHModifyOrder.objects.create() for _ in range(6)]
+        self.sfr = models.SFRModifyOrder.objects.create()
+
+    def test_routing(self):
+        self.assertEqual(worker_index('abc', 4), worker_index('abc', 4))
+        self.assertLessEqual({worker_index(o.uid, 3) for o in self.ovh}, {0, 1, 2})
+        executor = TransitionExecutor(workers=3)
+        executor.queues = [queue.Queue() for _ in range(3)]
+        for o in self.ovh:
+            executor.submit(models.OVHModifyOrder, o.uid, 'submit')
+        for i, q in enumerate(executor.queues):
+            self.assertTrue(all(worker_index(r.uid, 3) == i for r in q.queue))
+
+    def test_backpressure(self):
+        executor = TransitionExecutor(workers=1, queue_size=1)
+        executor.queues = [queue.Queue(1)]  # not started
+        executor.submit(models.OVHModifyOrder, self.ovh[0].uid, 'submit')
+        self.assertRaises(queue.Full, executor.submit, models.OVHModifyOrder, self.ovh[1].uid, 'submit', timeout=0.01)
+
+    def test_executor(self):
+        # a single worker: concurrent writes fail at once on the shared cache in memory sqlite test database
+        with self.assertLogs('kworkflows.executor', 'ERROR') as logs, \
+                TransitionExecutor(workers=1, batch_size=4) as executor:
+            for o in self.ovh:
+                executor.submit(models.OVHModifyOrder, o.uid, 'submit')
+                executor.submit('workflows.ProviderOrder', o.uid, 'trans_1')  # polymorphic, same worker
+            executor.submit(models.OVHModifyOrder, self.ovh[0].uid, 'submit')  # invalid state
+            executor.submit(models.OVHModifyOrder, 'unknown', 'submit')
+            executor.submit(models.ProviderOrder, self.sfr.uid, 'submit')
+        self.assertEqual(executor.stats['done'], 13)
+        self.assertEqual(executor.stats['failed'], 2)
+        self.assertEqual(len(logs.output), 2)
+        self.assertLessEqual(executor.stats['batches'], 15)
+        ovh = models.OVHModifyOrder.objects.filter(pk__in=[o.pk for o in self.ovh])
+        self.assertEqual(set(ovh.values_list('state', flat=True)), {'state_2'})
+        self.assertEqual(ovh.aggregate(Max('state_version'))['state_version__max'], 2)
+        self.sfr.refresh_from_db()
+        self.assertEqual(self.sfr.state, 'state_a')
+
+    def test_retry_timeout(self):
+        with mock.patch('kworkflows.executor.run_batch', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('kworkflows.executor', 'ERROR'), \
+                TransitionExecutor(workers=1, retry_timeout=0.2) as executor:
+            executor.submit(models.OVHModifyOrder, self.ovh[0].uid, 'submit')
+        self.assertEqual((executor.stats['done'], executor.stats['failed']), (0, 1))
+        self.assertGreater(executor.stats['retries'], 1)
+
+    def test_executor_workers(self):
+        # several workers on a file backed sqlite database, where concurrent writers would fail on locks
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as f, \
+                mock.patch.dict(connections.databases, {'file': dict(connections.databases['default'], NAME=f.name)}):
+            try:
+                call_command('migrate', database='file', verbosity=0)
+                for name in ('Other', 'SFR', 'OVH'):  # pks differing from the default database ones
+                    models.Operator.objects.using('file').create(name=name)
+                self.assertNotEqual(models.Operator.objects.using('file').get(name='OVH').pk,
+                                    models.Operator.objects.get(name='OVH').pk)
+                orders = [models.OVHModifyOrder.objects.db_manager('file').create() for _ in range(40)]
+                with TransitionExecutor(workers=4, batch_size=5, using='file') as executor:
+                    for o in orders:
+                        executor.submit(models.OVHModifyOrder, o.uid, 'submit')
+                        executor.submit(models.ProviderOrder, o.uid, 'trans_1')
+                stats = executor.stats
+                self.assertEqual((stats['done'], stats['failed'], stats['retries']), (80, 0, 0))  # no lock failure
+                self.assertEqual(models.ProviderOrder.objects.using('file').filter(state='state_2').count(), 40)
+            finally:
+                connections['file'].close()
+                del connections['file']
+
+    def test_stop_not_started(self):
+        executor = TransitionExecutor()
+        self.assertEqual(executor.stop(), {'done': 0, 'failed': 0, 'batches': 0, 'retries': 0})
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            for o in self.ovh:
+                f.write(json.dumps({'model': 'workflows.OVHModifyOrder', 'uid': o.uid, 'transition': 'submit'}) + '\n')
+            f.flush()
+            out = StringIO()
+            call_command('run_transitions', f.name, workers=1, stdout=out)
+        self.assertEqual(out.getvalue(), "6 done, 0 failed in {} batches\n".format(
+            out.getvalue().split()[-2]))
+        self.assertEqual(models.OVHModifyOrder.objects.filter(state='state_1').count(), 6)
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"model": "workflows.OVHModifyOrder"}\n')
+            f.flush()
+            self.assertRaises(CommandError, call_command, 'run_transitions', f.name, stdout=StringIO())
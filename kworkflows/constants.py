@@ -1,6 +1,10 @@
 
 CREATION_STATE = '#created'
 
+# concurrency management modes of workflow enabled models
+OPTIMISTIC = 'optimistic'
+PESSIMISTIC = 'pessimistic'
+
 
 class MultipleDifferentFirstStates(Exception):
     def __init__(self, cls_name):
@@ -34,6 +38,38 @@ class FailAdvanceState(Exception):
                          "in Workflow {} due to high concurrency".format(transition, state, cls_name))
 
 
+class MissingStateCodes(Exception):
+    def __init__(self, cls_name, states):
+        super().__init__("Workflow {}: no code found for states {} "
+                         "(see make_state_codes)".format(cls_name, ', '.join(sorted(states))))
+
+
+class InconsistentStateCodes(Exception):
+    def __init__(self, cls_name):
+        super().__init__("Workflow {}: Some state codes seem to be used twice".format(cls_name))
+
+
 class InvalidTransitionMethod(Exception):
     def __init__(self, cls_name):
         super().__init__("Invalid transition method in Workflow {}".format(cls_name))
+
+
+class UnreachableState(Exception):
+    def __init__(self, cls_name, from_state, to_state):
+        super().__init__("State {} is not reachable from state {} in Workflow {}".format(to_state, from_state, cls_name))
+
+
+class MissingHistory(Exception):
+    def __init__(self, cls_name):
+        super().__init__("Model {} has no history class (see 'histo')".format(cls_name))
+
+
+class InvalidStateRemap(Exception):
+    def __init__(self, cls_name, state):
+        super().__init__("Workflow {}: state {} of state_remap must be remapped to a state of the workflow, "
+                         "and not be one".format(cls_name, state))
+
+
+class GuardFailed(Exception):
+    def __init__(self, cls_name, transition):
+        super().__init__("Transition {} of {} rejected by its guard".format(transition, cls_name))
@@ -0,0 +1,196 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import random
+import threading
+import time
+import zlib
+
+from collections import namedtuple
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+from .workflow import polymorphic_objects
+
+logger = logging.getLogger(__name__)
+
+
+TransitionRequest = namedtuple('TransitionRequest', ('model', 'uid', 'transition', 'kwargs'))
+
+STOP = None  # sentinel put in worker queues to stop them
+
+
+def worker_index(uid, workers):
+    """ return the index of the worker handling an object, from a hash of its uid stable across processes
+    """
+    return zlib.crc32(str(uid).encode('utf-8')) % workers
+
+
+class TransitionExecutor(object):
+    """
+    Executor running transition requests on a pool of worker threads or processes.
+    Requests are routed by a hash of the object uid, so that an object is always handled by the same worker:
+    transitions of an object are serialized and do not conflict with each other.
+    Each worker takes the requests waiting in its queue, up to 'batch_size', and runs them in a single
+    transaction, each request in a savepoint (a failing request is logged and does not abort the batch,
+    except on an OperationalError, i.e. a deadlock, that aborts the batch and retries it).
+    SQLite allows a single writer at a time: on SQLite, the batches of the workers run one at a time.
+    Objects of a batch are loaded in their workflow proxy class with one query per model, whatever the model
+    of the requests (a proxy or the underlying model).
+    Params:
+    workers: number of workers
+    processes: if True, workers are forked processes, otherwise threads
+    batch_size: maximum number of requests per transaction
+    queue_size: capacity of each worker queue, 'submit' blocks when the queue of the worker is full
+    retry_timeout: time in seconds a batch whose transaction failed on an OperationalError (i.e. a deadlock or
+                   a lock timeout) is retried, after growing random delays, before counting its requests as failed
+    using: the database alias
+    Usage:
+    with TransitionExecutor(workers=8) as executor:
+        for request in feed:
+            executor.submit('workflows.ProviderOrder', request['uid'], request['transition'])
+    print(executor.stats)
+    """
+    def __init__(self, workers=4, processes=False, batch_size=100, queue_size=1000, retry_timeout=30, using=None):
+        self.workers = workers
+        self.processes = processes
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.retry_timeout = retry_timeout
+        self.using = using or DEFAULT_DB_ALIAS
+        self.pool = []
+        self.queues = []
+        self.results = None
+        self.stats = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.processes:
+            connections.close_all()  # forked processes must not share the connections
+            context = multiprocessing.get_context('fork')
+            Worker, Queue, Lock = context.Process, context.Queue, context.Lock
+        else:
+            Worker, Queue, Lock = threading.Thread, queue.Queue, threading.Lock
+        # concurrent sqlite writers fail on 'database is locked' rather than waiting for each other
+        lock = Lock() if connections[self.using].vendor == 'sqlite' else None
+        self.results = Queue()
+        self.queues = [Queue(self.queue_size) for _ in range(self.workers)]
+        self.pool = [Worker(target=run_worker,
+                            args=(q, self.results, self.batch_size, self.retry_timeout, self.using, lock), daemon=True)
+                     for q in self.queues]
+        for worker in self.pool:
+            worker.start()
+
+    def submit(self, model, uid, transition, timeout=None, **kwargs):
+        """ submit a transition request, blocking while the queue of its worker is full
+            :param model: the model class or its label (app_label.ModelName), a workflow proxy or the underlying
+                          model, whose objects are then handled in their workflow proxy class
+            :param uid: the uid of the object
+            :param transition: the name of the transition method to call
+            :param timeout: maximum time to wait for room in the queue, queue.Full is raised beyond
+            :param kwargs: arguments of the transition method
+        """
+        label = model if isinstance(model, str) else model._meta.label
+        self.queues[worker_index(uid, self.workers)].put(TransitionRequest(label, uid, transition, kwargs),
+                                                         timeout=timeout)
+
+    def stop(self):
+        """ wait for the workers to handle their pending requests and stop them, a no-op if not started
+            :return: the numbers of requests 'done' and 'failed', of 'batches' and of batch 'retries'
+        """
+        for q in self.queues:
+            q.put(STOP)
+        results = [self.results.get() for _ in self.pool]
+        for worker in self.pool:
+            worker.join()
+        self.pool, self.queues, self.results = [], [], None
+        self.stats = {k: sum(r[k] for r in results) for k in ('done', 'failed', 'batches', 'retries')}
+        return self.stats
+
+
+def run_worker(requests, results, batch_size, retry_timeout, using, lock=None):
+    stats = {'done': 0, 'failed': 0, 'batches': 0, 'retries': 0}
+    try:
+        stopped = False
+        while not stopped:
+            batch = [requests.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            if STOP in batch:
+                batch, stopped = batch[:batch.index(STOP)], True
+            deadline = time.monotonic() + retry_timeout
+            for retry in itertools.count() if batch else ():
+                try:
+                    if lock is None:
+                        run_batch(batch, using, stats)
+                    else:
+                        with lock:
+                            run_batch(batch, using, stats)
+                    break
+                except OperationalError:  # the transaction failed on a lock, nothing was written
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        stats['failed'] += len(batch)
+                        logger.exception("Batch of {} transitions failed after {} retries".format(len(batch), retry))
+                        break
+                    stats['retries'] += 1
+                    time.sleep(min(random.uniform(0, min(0.05 * 2 ** retry, 1)), remaining))
+                except Exception:  # the transaction failed, nothing was written
+                    stats['failed'] += len(batch)
+                    logger.exception("Batch of {} transitions failed".format(len(batch)))
+                    break
+    finally:
+        connections[using].close()
+        results.put(stats)
+
+
+def run_batch(batch, using, stats):
+    """ run a batch of requests in a transaction, each request in a savepoint
+    """
+    done = failed = 0
+    with transaction.atomic(using=using):
+        objects = load_objects(batch, using)
+        for request in batch:
+            obj = objects.get((apps.get_model(request.model)._meta.concrete_model, request.uid))
+            try:
+                if obj is None:
+                    raise LookupError("{} {} not found".format(request.model, request.uid))
+                with transaction.atomic(using=using):
+                    getattr(obj, request.transition)(**request.kwargs)
+                done += 1
+            except OperationalError:  # i.e. deadlock or lock timeout, the whole batch is retried
+                raise
+            except Exception:
+                failed += 1
+                logger.exception("Transition {} of {} {} failed".format(request.transition, request.model,
+                                                                        request.uid))
+                if obj is not None:  # its savepoint rolled back, the instance may be ahead of the db
+                    obj.refresh_from_db()
+    stats['done'] += done
+    stats['failed'] += failed
+    stats['batches'] += 1
+
+
+def load_objects(batch, using):
+    """ return the objects of a batch of requests in their workflow proxy class by (concrete model, uid),
+        with one query per concrete model, so that the requests of a batch on an object share its instance
+    """
+    uids = {}
+    for request in batch:
+        uids.setdefault(apps.get_model(request.model)._meta.concrete_model, set()).add(request.uid)
+    objects = {}
+    for model, model_uids in uids.items():
+        for obj in polymorphic_objects(model, model._base_manager.using(using).filter(uid__in=model_uids), using):
+            objects[model, obj.uid] = obj
+    return objects
@@ -0,0 +1,28 @@
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Fire the timeout transitions of the objects of a workflow enabled model "
+            "that stayed in a state longer than its workflow timeout")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="workflow enabled model, as app_label.ModelName")
+        parser.add_argument('--batch-size', type=int, default=100, help="number of objects claimed per transaction")
+        parser.add_argument('--interval', type=float, help="run again every INTERVAL seconds, until interrupted")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if not getattr(model, 'timeout_field', None):
+            raise CommandError("Model {} has no timeout field".format(options['model']))
+        while True:
+            stats = model._default_manager.all().fire_timeouts(batch_size=options['batch_size'])
+            self.stdout.write("{fired} fired, {failed} failed".format(**stats))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
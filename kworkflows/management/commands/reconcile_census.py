@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+
+from kworkflows.workflow import find_proxy
+
+
+class Command(BaseCommand):
+    help = "Reconcile the census counters of a workflow enabled model with the states found in its table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="workflow enabled model, as app_label.ModelName")
+        parser.add_argument('--dry-run', action='store_true', help="only report the differences")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if not getattr(model, 'census', None):
+            raise CommandError("Model {} has no census".format(options['model']))
+        with transaction.atomic():
+            # lock the counters first, so that no transition moves them between the count and the fix
+            list(model.census.objects.select_for_update().values_list('pk', flat=True))
+            actual = self.count_states(model)
+            counts = model.census.objects.counts()
+            workflows = {proxy.workflow.__name__ for proxy in model.get_workflow_proxies()}
+            diffs = {key: actual.get(key, 0) - counts.get(key, 0)
+                     for key in set(actual) | {key for key in counts if key[0] in workflows}}
+            diffs = {key: diff for key, diff in diffs.items() if diff}
+            for (workflow, state), diff in sorted(diffs.items()):
+                self.stdout.write("{} {}: {:+d}".format(workflow, state, diff))
+                if not options['dry_run']:
+                    model.census.objects.add(workflow, state, diff)
+        self.stdout.write("{} counters {}".format(len(diffs), 'to fix' if options['dry_run'] else 'fixed'))
+
+    @staticmethod
+    def count_states(model):
+        """ return the number of objects by (workflow name, state), with one query grouped by all the discriminators:
+            each group is counted in its first matching workflow proxy only, as the objects are loaded
+        """
+        index = model.get_proxy_index()
+        attnames = sorted({a for names, _ in index for a in names})
+        actual = {}
+        rows = model._base_manager.values(*attnames + ['state']).annotate(count=models.Count('pk')).order_by()
+        for row in rows:
+            proxy = find_proxy(index, SimpleNamespace(**row))
+            if proxy:
+                key = (proxy.workflow.__name__, row['state'])
+                actual[key] = actual.get(key, 0) + row['count']
+        return actual
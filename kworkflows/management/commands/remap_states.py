@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Remap the states of the objects of a workflow enabled model, with their history and census, "
+            "following the 'state_remap' of their workflows, by chunks of objects then of history records in pk order")
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help="workflow enabled model, as app_label.ModelName")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="number of objects per transaction")
+        parser.add_argument('--throttle', type=float, default=0, help="seconds to sleep between chunks")
+        parser.add_argument('--checkpoint', help="file storing the last pk done, to resume an interrupted run")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        qs = model._default_manager.all()
+        checkpoint = options['checkpoint']
+        progress = {'after': None}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                progress = json.load(f)
+            if 'histories_after' in progress:
+                self.stdout.write("Resuming history records after pk {}".format(progress['histories_after']))
+            else:
+                self.stdout.write("Resuming after pk {}".format(progress['after']))
+        if 'histories_after' not in progress:
+            self.remap_objects(qs, progress, options)
+            progress['histories_after'] = None
+            self.save_checkpoint(checkpoint, progress)
+        if model.histo:
+            self.remap_histories(qs, progress, options)
+
+    def remap_objects(self, qs, progress, options):
+        after = progress['after']
+        todo = (qs if after is None else qs.filter(pk__gt=after)).filter_workflow(lambda wf: wf.state_remap).count()
+        done = 0
+        while todo:
+            last, remapped = qs.remap_states(after, options['chunk_size'])
+            if last is None:
+                break
+            after = progress['after'] = last
+            done += remapped
+            self.save_checkpoint(options['checkpoint'], progress)
+            self.stdout.write("{}/{} objects remapped, last pk {}".format(done, todo, after))
+            if options['throttle']:
+                time.sleep(options['throttle'])
+        self.stdout.write("{} objects remapped".format(done))
+
+    def remap_histories(self, qs, progress, options):
+        # records are remapped whatever the current state of their object, so that left old states are remapped too
+        done = 0
+        while True:
+            last, remapped = qs.remap_histories(progress['histories_after'], options['chunk_size'])
+            if last is None:
+                break
+            progress['histories_after'] = last
+            done += remapped
+            self.save_checkpoint(options['checkpoint'], progress)
+            self.stdout.write("{} history records remapped, last pk {}".format(done, last))
+            if options['throttle']:
+                time.sleep(options['throttle'])
+        self.stdout.write("{} history records remapped".format(done))
+
+    @staticmethod
+    def save_checkpoint(checkpoint, progress):
+        if checkpoint:
+            with open(checkpoint, 'w') as f:
+                json.dump(progress, f)
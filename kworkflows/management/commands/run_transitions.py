@@ -0,0 +1,41 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kworkflows.executor import TransitionExecutor
+
+
+class Command(BaseCommand):
+    help = ("Run transition requests read as json lines {\"model\": \"app_label.ModelName\", \"uid\": ..., "
+            "\"transition\": ..., \"kwargs\": {...}} with a TransitionExecutor")
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', nargs='?', help="file of json lines, defaults to the standard input")
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--processes', action='store_true', help="use worker processes instead of threads")
+        parser.add_argument('--batch-size', type=int, default=100, help="maximum number of requests per transaction")
+        parser.add_argument('--queue-size', type=int, default=1000, help="capacity of each worker queue")
+        parser.add_argument('--retry-timeout', type=float, default=30,
+                            help="seconds a batch failing on a lock is retried before its requests are failed")
+
+    def handle(self, *args, **options):
+        executor = TransitionExecutor(workers=options['workers'], processes=options['processes'],
+                                      batch_size=options['batch_size'], queue_size=options['queue_size'],
+                                      retry_timeout=options['retry_timeout'])
+        lines = open(options['input']) if options['input'] else sys.stdin
+        try:
+            with executor:
+                for n, line in enumerate(lines, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                        executor.submit(request['model'], request['uid'], request['transition'],
+                                        **request.get('kwargs', {}))
+                    except (ValueError, KeyError) as e:
+                        raise CommandError("Invalid request at line {}: {}".format(n, e))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write("{done} done, {failed} failed in {batches} batches".format(**executor.stats))
@@ -0,0 +1,201 @@
+"""
+Metrics of transitions, creations and history writes, reported to a pluggable backend.
+Disabled by default: instrumented code paths then only get a shared no-op context manager.
+Usage:
+from kworkflows import metrics
+stats = metrics.enable()  # in memory backend, or enable(MyBackend())
+...
+stats.get('transition.calls', workflow='OVHModifyWorkflow', transition='submit')
+stats.timing_stats('transition.db_time', workflow='OVHModifyWorkflow', transition='submit')
+Metrics:
+transition.calls, transition.errors, transition.queries: counters, tagged by workflow and transition
+transition.time, transition.body_time, transition.db_time: timings of transition methods, db time being the time
+                                                          spent in the attempts of safe_advance_state (backoff
+                                                          sleeps excluded), body time the rest
+advance.conflicts, advance.retries, advance.exhausted: optimistic concurrency counters, tagged by workflow
+                                                       and transition (see RetryPolicy)
+history.time: timing of history writes, tagged by workflow
+create.calls, create.queries, create.time: creations by WorkflowEnabledManager.create, tagged by workflow
+"""
+import functools
+import threading
+import time
+
+from collections import Counter, deque
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+backend = None
+
+_local = threading.local()
+
+
+class InMemoryMetrics(object):
+    """
+    Default metrics backend, keeping counters and timing statistics (count, total, max) in memory
+    A backend is any object with the 'increment' and 'timing' methods
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.timings = {}
+
+    def increment(self, name, value=1, **tags):
+        with self.lock:
+            self.counters[name, tuple(sorted(tags.items()))] += value
+
+    def timing(self, name, seconds, **tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self.lock:
+            stats = self.timings.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def get(self, name, **tags):
+        """ return the value of a counter
+        """
+        return self.counters[name, tuple(sorted(tags.items()))]
+
+    def timing_stats(self, name, **tags):
+        """ return the count, total, mean and max of a timing, in seconds
+        """
+        count, total, max_ = self.timings.get((name, tuple(sorted(tags.items()))), (0, 0.0, 0.0))
+        return {'count': count, 'total': total, 'mean': total / count if count else 0.0, 'max': max_}
+
+    def report(self):
+        """ return all the metrics as a list of (name, tags, value) sorted by name,
+            value being a counter value or the timing statistics
+        """
+        items = [(name, dict(tags), value) for (name, tags), value in self.counters.items()]
+        items += [(name, dict(tags), self.timing_stats(name, **dict(tags))) for name, tags in self.timings]
+        return sorted(items, key=lambda x: (x[0], sorted(x[1].items())))
+
+
+def enable(metrics_backend=None):
+    """ enable instrumentation with the given backend, defaults to an InMemoryMetrics
+        :return: the backend
+    """
+    global backend
+    backend = metrics_backend or InMemoryMetrics()
+    return backend
+
+
+def disable():
+    global backend
+    backend = None
+
+
+class NullContext(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+null_context = NullContext()
+
+
+def measure(name, using, split_db=False, **tags):
+    """ return a context manager reporting the time and the number of queries of a block (see Measure),
+        or a no-op one if instrumentation is disabled
+    """
+    return null_context if backend is None else Measure(name, using, split_db, **tags)
+
+
+def db_time():
+    """ return a context manager adding the time of a block to the db time of the enclosing 'measure' block,
+        or a no-op one if instrumentation is disabled
+    """
+    return null_context if backend is None else DbTime()
+
+
+def db_timed(func):
+    """ return 'func' wrapped to add the time of each of its calls to the db time of the enclosing 'measure' block
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with db_time():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def timer(name, **tags):
+    """ return a context manager reporting the time of a block as a timing,
+        or a no-op one if instrumentation is disabled
+    """
+    return null_context if backend is None else Timer(name, **tags)
+
+
+class Measure(object):
+    """
+    Context manager reporting the time and the number of queries of a block as '<name>.time',
+    '<name>.calls' and '<name>.queries' metrics, or '<name>.errors' if it raises.
+    With split_db=True, the time spent in 'db_time' blocks is reported as '<name>.db_time',
+    and the rest as '<name>.body_time'.
+    Queries are counted with the debug cursor of the connection, on a temporary log
+    """
+    def __init__(self, name, using, split_db=False, **tags):
+        self.name = name
+        self.connection = connections[using or DEFAULT_DB_ALIAS]
+        self.split_db = split_db
+        self.tags = tags
+
+    def __enter__(self):
+        connection = self.connection
+        self.saved_log = (connection.queries_log, connection.force_debug_cursor, connection.queries_logged)
+        connection.queries_log = deque(maxlen=connection.queries_log.maxlen)
+        connection.force_debug_cursor = True
+        if self.split_db:
+            self.outer_db_time = getattr(_local, 'db_time', 0.0)
+            _local.db_time = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        elapsed = time.perf_counter() - self.start
+        connection = self.connection
+        queries_log, connection.force_debug_cursor, logged = self.saved_log
+        n_queries = len(connection.queries_log)
+        if logged:  # the queries were logged anyway, keep them
+            queries_log.extend(connection.queries_log)
+        connection.queries_log = queries_log
+        if self.split_db:
+            db = _local.db_time
+            _local.db_time = self.outer_db_time
+        if backend is None:  # disabled meanwhile
+            return
+        if exc_type is not None:
+            backend.increment(self.name + '.errors', **self.tags)
+            return
+        backend.increment(self.name + '.calls', **self.tags)
+        backend.increment(self.name + '.queries', n_queries, **self.tags)
+        backend.timing(self.name + '.time', elapsed, **self.tags)
+        if self.split_db:
+            backend.timing(self.name + '.db_time', db, **self.tags)
+            backend.timing(self.name + '.body_time', elapsed - db, **self.tags)
+
+
+class DbTime(object):
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        _local.db_time = getattr(_local, 'db_time', 0.0) + time.perf_counter() - self.start
+
+
+class Timer(object):
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None and backend is not None:
+            backend.timing(self.name, time.perf_counter() - self.start, **self.tags)
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# sent by transition methods, with the workflow proxy class as sender,
+# inside the transaction and after the row lock for pessimistic concurrency
+pre_transition = Signal(providing_args=['instance', 'transition', 'field', 'from_state'])
+# sent when the transition method returned (not when it raised)
+post_transition = Signal(providing_args=['instance', 'transition', 'field', 'from_state', 'to_state', 'result'])
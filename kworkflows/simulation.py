@@ -0,0 +1,188 @@
+"""
+Offline simulation of a population of objects running through a workflow, for capacity planning.
+Requires numpy.
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, only required to run simulations
+    np = None
+
+
+class Simulation(object):
+    """
+    Simulate objects running through a specific workflow class, from its initial state to a terminal state,
+    in vectorized batches: states and transitions are encoded as integers, and each step draws the next
+    transition and the time spent in the state of all the running objects at once.
+    From a state, the next transition is drawn among the available transitions, in proportion of their
+    'probabilities', the time spent in the state follows an exponential distribution of mean the 'latencies'
+    of the transition. The workflow 'timeouts' are applied: their transition is fired at their delay
+    if the drawn transition would come later.
+    Params:
+    workflow: the specific workflow class
+    probabilities: relative weights of the transitions, defaults to 1, a transition of weight 0 is never drawn
+    latencies: mean time spent in a state before each transition, in seconds, defaults to 1
+    seed: seed of the random generator, for reproducible runs
+    Usage:
+    simulation = Simulation(OVHModifyWorkflow, probabilities={'trans_2': 0.2}, latencies={'submit': 60})
+    result = simulation.run(1000000, horizon=3600)
+    print(result.report(arrival_rate=50))
+    """
+    def __init__(self, workflow, probabilities=None, latencies=None, seed=None):
+        if np is None:
+            raise ImportError("numpy is required to run simulations")
+        self.workflow = workflow
+        self.rng = np.random.default_rng(seed)
+        probabilities, latencies = probabilities or {}, latencies or {}
+        self.states = [s[0] for s in workflow.states]
+        self.transitions = [tr[0] for tr in workflow.transitions]
+        state_index = {s: i for i, s in enumerate(self.states)}
+        transition_index = {tr: i for i, tr in enumerate(self.transitions)}
+        choices = [[(tr, to) for tr, to in workflow._table[s].items() if probabilities.get(tr, 1) > 0]
+                   for s in self.states]
+        n_states, width = len(self.states), max(1, max(len(c) for c in choices))
+        # next transition tables indexed by state then choice, padded choices are never drawn
+        self.cumulated = np.full((n_states, width), 2.0)
+        self.targets = np.zeros((n_states, width), dtype=np.int64)
+        self.transition_ids = np.zeros((n_states, width), dtype=np.int64)
+        self.means = np.ones((n_states, width))
+        for i, state_choices in enumerate(choices):
+            weights = np.array([probabilities.get(tr, 1) for tr, _ in state_choices], dtype=float)
+            for j, (tr, to) in enumerate(state_choices):
+                self.targets[i, j] = state_index[to]
+                self.transition_ids[i, j] = transition_index[tr]
+                self.means[i, j] = latencies.get(tr, 1)
+            if state_choices:
+                self.cumulated[i, :len(state_choices)] = np.cumsum(weights) / weights.sum()
+                self.cumulated[i, len(state_choices) - 1] = 1.0
+        self.timeout_delays = np.full(n_states, np.inf)
+        self.timeout_targets = np.zeros(n_states, dtype=np.int64)
+        self.timeout_ids = np.zeros(n_states, dtype=np.int64)
+        for state, (tr, delay) in workflow._timeouts.items():
+            i = state_index[state]
+            self.timeout_delays[i] = delay.total_seconds()
+            self.timeout_targets[i] = state_index[workflow._table[state][tr]]
+            self.timeout_ids[i] = transition_index[tr]
+            if not choices[i]:  # only left by its timeout
+                self.means[i, 0] = np.inf
+        self.terminal = np.array([not c and s not in workflow._timeouts for s, c in zip(self.states, choices)])
+        self.initial = state_index[workflow.initial_state]
+
+    def run(self, n, horizon, points=100, max_steps=1000, batch_size=100000):
+        """ simulate n objects all created at time 0
+            :param horizon: the end time of the state occupancy series, in seconds
+            :param points: the number of intervals of the occupancy series
+            :param max_steps: maximum number of transitions per object, objects still running are left
+                              in their state
+            :param batch_size: number of objects simulated at once, to bound the memory used
+            :return: a SimulationResult
+        """
+        n_states, n_transitions = len(self.states), len(self.transitions)
+        step = horizon / points
+        occupancy = np.zeros(n_states * (points + 2))
+        counts = np.zeros(n_transitions)
+        time_in_state = np.zeros(n_states)
+        terminal_times = []
+
+        def occupy(states, start, end):
+            # count objects in a state at each time point of [start, end), with a difference array
+            first = np.minimum(np.ceil(start / step), points + 1).astype(np.int64)
+            last = np.minimum(np.ceil(end / step), points + 1).astype(np.int64)
+            size = n_states * (points + 2)
+            occupancy[:] += np.bincount(states * (points + 2) + first, minlength=size)
+            occupancy[:] -= np.bincount(states * (points + 2) + last, minlength=size)
+
+        for done in range(0, n, batch_size):
+            m = min(batch_size, n - done)
+            state = np.full(m, self.initial, dtype=np.int64)
+            time = np.zeros(m)
+            for _ in range(max_steps):
+                running = np.nonzero(~self.terminal[state])[0]
+                if not len(running):
+                    break
+                s = state[running]
+                choice = (self.rng.random(len(running))[:, None] >= self.cumulated[s]).sum(axis=1)
+                targets, ids = self.targets[s, choice], self.transition_ids[s, choice]
+                delays = self.rng.exponential(self.means[s, choice])
+                late = delays > self.timeout_delays[s]
+                targets[late], ids[late] = self.timeout_targets[s[late]], self.timeout_ids[s[late]]
+                delays[late] = self.timeout_delays[s[late]]
+                end = time[running] + delays
+                occupy(s, time[running], end)
+                time_in_state += np.bincount(s, weights=delays, minlength=n_states)
+                counts += np.bincount(ids, minlength=n_transitions)
+                state[running], time[running] = targets, end
+            occupy(state, time, np.full(m, np.inf))
+            terminal_times.append(np.where(self.terminal[state], time, np.nan))
+        occupancy = np.cumsum(occupancy.reshape(n_states, points + 2), axis=1)[:, :points + 1]
+        return SimulationResult(
+            n=n,
+            times=np.linspace(0, horizon, points + 1),
+            occupancy={s: occupancy[i].astype(np.int64) for i, s in enumerate(self.states)},
+            transitions={tr: counts[i] / n for i, tr in enumerate(self.transitions)},
+            time_in_state={s: time_in_state[i] / n for i, s in enumerate(self.states) if not self.terminal[i]},
+            time_to_terminal=np.concatenate(terminal_times),
+        )
+
+
+class SimulationResult(object):
+    """
+    Results of a simulation:
+    n: the number of objects simulated
+    times: the time points of the occupancy series
+    occupancy: the number of objects in each state at each time point, by state
+    transitions: the mean number of each transition per object, by transition
+    time_in_state: the mean time an object spends in each non terminal state, by state
+    time_to_terminal: the time each object reached a terminal state (nan if it did not)
+    """
+    def __init__(self, n, times, occupancy, transitions, time_in_state, time_to_terminal):
+        self.n = n
+        self.times = times
+        self.occupancy = occupancy
+        self.transitions = transitions
+        self.time_in_state = time_in_state
+        self.time_to_terminal = time_to_terminal
+
+    @property
+    def terminated(self):
+        """ the fraction of objects that reached a terminal state
+        """
+        return float(np.mean(~np.isnan(self.time_to_terminal)))
+
+    def percentiles(self, q=(50, 90, 95, 99)):
+        """ return the percentiles of the time to terminal state of the objects that reached one, by percentile
+        """
+        times = self.time_to_terminal[~np.isnan(self.time_to_terminal)]
+        return {p: float(v) for p, v in zip(q, np.percentile(times, q))} if len(times) else {p: math.nan for p in q}
+
+    def rates(self, arrival_rate, histo_create=True):
+        """ return the expected load of a steady flow of 'arrival_rate' objects created per second:
+            'transitions' per second by transition, total 'updates' per second (one per transition),
+            'history_writes' per second (including creations if histo_create),
+            and number of objects 'in_flight' by non terminal state (Little's law)
+        """
+        transitions = {tr: arrival_rate * n for tr, n in self.transitions.items()}
+        updates = sum(transitions.values())
+        return {
+            'transitions': transitions,
+            'updates': updates,
+            'history_writes': updates + (arrival_rate if histo_create else 0),
+            'in_flight': {s: arrival_rate * t for s, t in self.time_in_state.items()},
+        }
+
+    def report(self, arrival_rate=None):
+        """ return a text report of the results, with the expected load if 'arrival_rate' is given
+        """
+        lines = ["{} objects, {:.1%} reached a terminal state".format(self.n, self.terminated)]
+        lines.append("time to terminal state: " + ', '.join(
+            "p{} {:.1f}s".format(p, v) for p, v in sorted(self.percentiles().items())))
+        lines.append("transitions per object: " + ', '.join(
+            "{} {:.3f}".format(tr, n) for tr, n in sorted(self.transitions.items())))
+        if arrival_rate:
+            rates = self.rates(arrival_rate)
+            lines.append("at {} creations/s: {:.1f} updates/s, {:.1f} history writes/s".format(
+                arrival_rate, rates['updates'], rates['history_writes']))
+            lines.append("objects in flight: " + ', '.join(
+                "{} {:.0f}".format(s, n) for s, n in sorted(rates['in_flight'].items())))
+        return '\n'.join(lines)
@@ -1,12 +1,28 @@
 import functools
 import inspect
 import logging
+import operator
+import random
+import threading
+import time
 
-from django.db import models
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+from django.db.models import Prefetch, signals
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import RawSQL
+from django.db.models.query import ModelIterable
 from django.db.models.base import ModelBase
 from django.utils import timezone
 
+from . import metrics
 from .constants import *
+from .signals import post_transition, pre_transition
 
 try:
   basestring
@@ -28,15 +44,199 @@ class classproperty(object):
         return self.f(owner)
 
 
-def retry_once(f):
-    """ retry a callable once if return value evaluates to False
+class RetryPolicy(object):
     """
-    def wrapped(*args, **kwargs):
-        if not f(*args, **kwargs):
-            logger.warning("Retrying transition {}".format(f.__name__))
-            if not f(*args, **kwargs):
-                logger.error("Aborting transition {}".format(f.__name__))
-    return wrapped
+    Retry policy of safe_advance_state on optimistic concurrency conflicts
+    Params:
+    max_attempts: maximum number of attempts, including the first one, defaults to 2
+    backoff: delay in seconds before the first retry, doubled at each retry, defaults to 0 (immediate retries)
+    max_backoff: maximum delay in seconds between 2 attempts
+    jitter: if True, each delay is randomly drawn between 0 and its computed value,
+            so that colliding retries do not collide again in lockstep
+    deadline: optional maximum time in seconds, no retry is attempted beyond
+    raise_on_exhaustion: if True, FailAdvanceState is raised when all attempts failed, otherwise an error is logged
+    Counters 'calls', 'attempts', 'conflicts' and 'exhausted' can be used to tune the policy
+    """
+    def __init__(self, max_attempts=2, backoff=0, max_backoff=1, jitter=True, deadline=None,
+                 raise_on_exhaustion=False):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.raise_on_exhaustion = raise_on_exhaustion
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.calls = self.attempts = self.conflicts = self.exhausted = 0
+
+    def delay(self, retry):
+        """ return the delay before the given retry (starting at 0)
+        """
+        delay = min(self.backoff * 2 ** retry, self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+    def run(self, attempt, prepare_retry, name, workflow=None):
+        """ call 'attempt' until it returns a true value or the policy is exhausted,
+            calling 'prepare_retry' before each retry.
+            Conflicts, retries and exhaustions are also reported to the metrics backend, if enabled,
+            tagged by workflow and transition name
+            :return: the value returned by the last attempt
+        """
+        self.calls += 1
+        start = time.monotonic()
+        result = None
+        for n in range(self.max_attempts):
+            if n:
+                delay = self.delay(n - 1)
+                if self.deadline is not None and time.monotonic() + delay - start > self.deadline:
+                    break
+                logger.warning("Retrying transition {} of {}".format(name, workflow))
+                if metrics.backend is not None:
+                    metrics.backend.increment('advance.retries', workflow=workflow, transition=name)
+                if delay:
+                    time.sleep(delay)
+                prepare_retry()
+            self.attempts += 1
+            result = attempt()
+            if result:
+                return result
+            self.conflicts += 1
+            if metrics.backend is not None:
+                metrics.backend.increment('advance.conflicts', workflow=workflow, transition=name)
+        self.exhausted += 1
+        logger.error("Aborting transition {} of {}".format(name, workflow))
+        if metrics.backend is not None:
+            metrics.backend.increment('advance.exhausted', workflow=workflow, transition=name)
+        return result
+
+
+default_retry_policy = RetryPolicy()
+
+
+class CachedLookup(object):
+    """
+    Cached lookup of a related object, to be used as a value in 'specific_fields', i.e.:
+    'operator': CachedLookup(Operator, name='OVH')
+    Params:
+    model: the model of the related object
+    ttl: time to live of the cached value in seconds, defaults to None (no expiration)
+    id_only: if True, only the pk of the related object is fetched and cached,
+             and the field is set through its attname (i.e. 'operator_id')
+    filters: the lookup parameters, they must select a single object
+    The value is looked up and cached per database alias.
+    The cache is invalidated on save or delete of any object of the model, or by calling 'invalidate'
+    """
+    def __init__(self, model, ttl=None, id_only=False, **filters):
+        self.model = model
+        self.ttl = ttl
+        self.id_only = id_only
+        self.filters = filters
+        self.invalidate()
+        signals.post_save.connect(self.invalidate, sender=model, weak=False)
+        signals.post_delete.connect(self.invalidate, sender=model, weak=False)
+
+    def invalidate(self, **kwargs):
+        self._cached = {}
+
+    def __call__(self, using=None):
+        using = using or DEFAULT_DB_ALIAS
+        value, expires = self._cached.get(using, (None, 0))
+        if time.monotonic() >= expires:
+            qs = self.model._default_manager.using(using).filter(**self.filters)
+            value = qs.values_list('pk', flat=True).get() if self.id_only else qs.get()
+            self._cached[using] = (value, float('inf') if self.ttl is None else time.monotonic() + self.ttl)
+        return value
+
+
+GUARD_LOOKUPS = {
+    'exact': operator.eq,
+    'iexact': lambda a, b: a.lower() == b.lower(),
+    'in': lambda a, b: a in b,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'contains': lambda a, b: b in a,
+    'icontains': lambda a, b: b.lower() in a.lower(),
+    'startswith': lambda a, b: a.startswith(b),
+    'endswith': lambda a, b: a.endswith(b),
+}
+
+
+def guard_value(obj, path):
+    """ return the value of a lookup path on an object, a foreign key ending the path gives the pk
+        of the related object, without loading it
+    """
+    for i, name in enumerate(path):
+        if obj is None:
+            return None
+        field = obj._meta.pk if name == 'pk' else obj._meta.get_field(name)
+        if i == len(path) - 1 and field.many_to_one:
+            return getattr(obj, field.attname)
+        obj = getattr(obj, field.name)
+    return obj
+
+
+def split_guard_key(model, key):
+    """ split a lookup key of a guard on a model into its fields path and its lookup ('exact' if none),
+        raise ImproperlyConfigured if the key has no field, a transform or a lookup not supported in Python
+        (see GUARD_LOOKUPS). Fields of relations not resolved yet (at model creation) are not checked
+    """
+    names, path = key.split(LOOKUP_SEP), []
+    while len(path) < len(names) and isinstance(model, ModelBase):
+        name = names[len(path)]
+        try:
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        path.append(name)
+        model = field.related_model
+    rest = names[len(path):]
+    if rest and not isinstance(model, ModelBase) and model is not None:  # unresolved relation
+        path, rest = path + rest[:-1], rest[-1:]
+        if rest[0] not in GUARD_LOOKUPS and rest[0] != 'isnull':
+            path, rest = path + rest, []
+    if not path or len(rest) > 1 or (rest and rest[0] not in GUARD_LOOKUPS and rest[0] != 'isnull'):
+        raise ImproperlyConfigured("Unsupported guard lookup {}: guards are evaluated in Python, "
+                                   "with the lookups isnull, {}".format(key, ', '.join(sorted(GUARD_LOOKUPS))))
+    return path, rest[0] if rest else 'exact'
+
+
+def check_guard_lookups(guard, model):
+    """ raise ImproperlyConfigured if a guard uses a lookup that cannot be evaluated in Python on the model
+    """
+    for child in guard.children:
+        if isinstance(child, models.Q):
+            check_guard_lookups(child, model)
+        else:
+            split_guard_key(model, child[0])
+
+
+def evaluate_guard(guard, obj):
+    """ evaluate a guard, a Q object, on an object in Python, as its filter would in the database.
+        Supported lookups are isnull and those of GUARD_LOOKUPS, values can be F expressions
+    """
+    results = []
+    for child in guard.children:
+        if isinstance(child, models.Q):
+            results.append(evaluate_guard(child, obj))
+            continue
+        key, value = child
+        path, lookup = split_guard_key(type(obj), key)
+        actual = guard_value(obj, path)
+        if isinstance(value, models.F):
+            value = guard_value(obj, value.name.split(LOOKUP_SEP))
+        if lookup == 'isnull':
+            results.append((actual is None) == bool(value))
+        elif lookup == 'in':
+            results.append(actual in [getattr(v, 'pk', v) for v in value])
+        elif actual is None or value is None:  # sql comparisons with null are false
+            results.append(lookup == 'exact' and actual is value)
+        else:
+            results.append(GUARD_LOOKUPS[lookup](actual, getattr(value, 'pk', value)))
+    result = all(results) if guard.connector == models.Q.AND else any(results)
+    return not result if guard.negated else result
 
 
 class StateField(models.Field):
@@ -46,78 +246,260 @@ class StateField(models.Field):
     max_length: will be overriden by the longest state length if necessary, defaults to 16
     choices: if True, will collect the states from all the subclasses of the mother class
              in the CharField's choices
+    coded: if True, renders as a SmallIntegerField storing the states codes declared in the mother class
+           'state_codes' (see KWorkFlow.get_state_codes), while states are still handled by name in Python
+           (values, lookups, choices)
+    version_field: for an additional state field of a model (the main one being 'state'), the name of its
+                   version counter, an IntegerField added to the model. The workflow of an additional
+                   state field is a specific workflow class, not a mother class
     This class works in conjunction with class KWorkFlow
     CharField's 'default' will be set as the first state of all the subclasses (if it is the same,
       otherwise an exception is raised)
     """
     def __init__(self, *args, **kwargs):
+        self.state_codes = None
+        self.workflow = None
+        self.version_field = kwargs.pop('version_field', None)
         if args:
-            workflow = args[0]
+            workflow = self.workflow = args[0]
+            if kwargs.pop('coded', False):
+                self._clone_args = (args, dict(kwargs, coded=True))
+                self.state_codes = workflow.get_state_codes()
+                self.code_states = {v: k for k, v in self.state_codes.items()}
             args = args[1:]
-            states = workflow.get_aggregated_states()
-            l = max(len(s[0]) for s in states)
-            max_length = max(kwargs.get('max_length', 16), len(CREATION_STATE))
-            kwargs['max_length'] = max(max_length, l)
+            specific = hasattr(workflow, '_states')
+            states = workflow.states if specific else workflow.get_aggregated_states()
+            if self.state_codes is None:
+                l = max(len(s[0]) for s in states)
+                max_length = max(kwargs.get('max_length', 16), len(CREATION_STATE))
+                kwargs['max_length'] = max(max_length, l)
             if kwargs.pop('choices', False):
                 kwargs['choices'] = states
-            kwargs['default'] = workflow.get_initial_state()
+            kwargs['default'] = workflow.initial_state if specific else workflow.get_initial_state()
         super().__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super().contribute_to_class(cls, name, *args, **kwargs)
+        if self.version_field and not any(f.name == self.version_field for f in cls._meta.local_fields):
+            models.IntegerField(default=0).contribute_to_class(cls, self.version_field)
+
     def deconstruct(self):
         name, path, args, kwargs = super().deconstruct()
-        return name, 'models.CharField', args, kwargs
+        if self.state_codes is None:
+            return name, 'django.db.models.CharField', args, kwargs
+        if 'choices' in kwargs:
+            kwargs['choices'] = [(self.state_codes[k], v) for k, v in kwargs['choices']]
+        if 'default' in kwargs:
+            kwargs['default'] = self.state_codes[kwargs['default']]
+        return name, 'django.db.models.SmallIntegerField', args, kwargs
+
+    def clone(self):
+        if self.state_codes is None:
+            return super().clone()
+        args, kwargs = self._clone_args
+        return self.__class__(*args, **kwargs)
+
+    def get_internal_type(self):
+        return super().get_internal_type() if self.state_codes is None else 'SmallIntegerField'
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if self.state_codes is None or value is None or not isstring(value):
+            return value
+        return self.state_codes[value]
+
+    def get_db_converters(self, connection):
+        # no per row converter for states stored by name
+        converters = super().get_db_converters(connection)
+        return converters if self.state_codes is None else [self.decode_state] + converters
 
+    def decode_state(self, value, expression, connection, context):
+        return value if value is None else self.code_states[value]
 
-class KWorkFlow(object):
+    def to_python(self, value):
+        if self.state_codes is None or value is None or isstring(value):
+            return value
+        return self.code_states[int(value)]
+
+
+# attributes set by KWorkFlow.compile
+COMPILED_ATTRIBUTES = frozenset(('_states', '_transitions', '_transitions_set', '_table', '_available',
+                                 '_terminal_states', '_paths', '_timeouts'))
+
+
+class KWorkFlowMeta(type):
+    """
+    Compile the states and transitions of each specific workflow class once, at class creation,
+    or at first use of a compiled attribute if the workflow is 'lazy'.
+    Invalidate the aggregated states cached by the mother classes when a subclass is created.
+    """
+    def __init__(cls, *args):
+        super().__init__(*args)
+        for base in cls.__mro__[1:]:
+            for name in ('_aggregated_states', '_common_initial_state'):
+                if name in base.__dict__:
+                    delattr(base, name)
+        if hasattr(cls, 'states') and hasattr(cls, 'transitions'):
+            # tables compiled for a base class would hide the missing ones of a lazy subclass
+            if not cls.lazy or any('_table' in base.__dict__ for base in cls.__mro__[1:]):
+                cls.compile()
+
+    def __getattr__(cls, name):
+        # only called when normal lookup fails, i.e. on first use of a lazy workflow
+        if name in COMPILED_ATTRIBUTES and hasattr(cls, 'states') and hasattr(cls, 'transitions'):
+            cls.compile()
+            return type.__getattribute__(cls, name)
+        raise AttributeError("type object '{}' has no attribute '{}'".format(cls.__name__, name))
+
+
+class KWorkFlow(object, metaclass=KWorkFlowMeta):
     """
     Base workflow class with a factory
     Usage: define your set of polymorphic workflows from a common mother class that you create this way:
     MyWorkflowFamilly = KWorkFlow.factory('MyWorkflowFamilly')
     """
 
+    retry_policy = None  # if None, the default retry policy is used
+    lazy = False  # if True, states and transitions are compiled and checked at first use (see check_workflows)
+    timeouts = ()  # (transition, state, timedelta) fired when an object stays in state longer than the delay
+    state_remap = {}  # {old state: new state} of states renamed or merged, applied by the remap_states command
+
     @classmethod
-    def factory(cls, name):
-        return type(name, (cls,), {'__module__': __name__})
+    def factory(cls, name, **attrs):
+        return type(name, (cls,), dict(attrs, __module__=__name__))
 
     # -------------- class methods called by mother class only ----------------
 
     @classmethod
     def get_aggregated_states(cls):
         """ Called by mother class only
-            return the tuple of aggregated states found in subclasses
+            return the tuple of aggregated states found in subclasses, cached until a new subclass is created
         """
-        states = {}
-        for sc in cls.__subclasses__():
-            states.update(dict(sc.states))
-        return tuple((k, v) for k, v in states.items())
+        if '_aggregated_states' not in cls.__dict__:
+            states = {}
+            for sc in cls.__subclasses__():
+                states.update(dict(sc.states))
+            cls._aggregated_states = tuple((k, v) for k, v in states.items())
+        return cls._aggregated_states
 
     @classmethod
     def get_initial_state(cls):
         """ Called by mother class only
-            return common initial state of all subclasses, raise if ambiguous
+            return common initial state of all subclasses, raise if ambiguous,
+            cached until a new subclass is created
+        """
+        if '_common_initial_state' not in cls.__dict__:
+            first_states = {sc.initial_state for sc in cls.__subclasses__()}
+            if len(first_states) > 1:
+                raise MultipleDifferentFirstStates(cls.__name__)
+            cls._common_initial_state = first_states.pop()
+        return cls._common_initial_state
+
+    @classmethod
+    def get_state_codes(cls):
+        """ Called by mother class only
+            return the mapping of states to the integer codes used for their storage by coded StateFields,
+            declared in the mother class 'state_codes' attribute (i.e. passed to factory), 0 being reserved
+            for CREATION_STATE. Raise if a state of the subclasses has no code or if a code is used twice.
+            Codes of removed states should be kept in the mapping, so that they are never reused
+        """
+        codes = dict(getattr(cls, 'state_codes', None) or {})
+        codes[CREATION_STATE] = 0
+        missing = {s[0] for s in cls.get_aggregated_states()} - set(codes)
+        if missing:
+            raise MissingStateCodes(cls.__name__, missing)
+        if len(set(codes.values())) != len(codes):
+            raise InconsistentStateCodes(cls.__name__)
+        return codes
+
+    @classmethod
+    def make_state_codes(cls):
+        """ Called by mother class only
+            return the 'state_codes' of the mother class extended with new codes for the states that have none,
+            to be pasted in the mother class declaration
         """
-        first_states = {sc.initial_state for sc in cls.__subclasses__()}
-        if len(first_states) > 1:
-            raise MultipleDifferentFirstStates(cls.__name__)
-        return first_states.pop()
+        codes = dict(getattr(cls, 'state_codes', None) or {})
+        next_code = max(codes.values(), default=0) + 1
+        for state, _ in cls.get_aggregated_states():
+            if state not in codes:
+                codes[state] = next_code
+                next_code += 1
+        return codes
 
     # -------------- class methods called by specific class only ----------------
 
+    @classmethod
+    def compile(cls):
+        """ format states and transitions, do some consistency checks,
+            and build the transition table indexed by state then transition,
+            the sets of available transitions per state and the set of terminal states,
+            the shortest paths from a state being built at first use (see paths_from)
+        """
+        cls._states = {s[0] for s in cls.states}
+        if len(cls.states) != len(cls._states):
+            raise InconsistentStateList(cls.__name__)
+        cls._transitions = {tr: ((fr,), to) if isstring(fr) else (tuple(fr), to) for tr, fr, to in cls.transitions}
+        cls._transitions_set = set(cls._transitions)
+        for tr, v in cls._transitions.items():
+            if v[1] not in cls._states:
+                raise InconsistentStateInTransition(cls.__name__, tr, 'final')
+            if not set(v[0]).issubset(cls._states):
+                raise InconsistentStateInTransition(cls.__name__, tr, 'start')
+        table = {s: {} for s in cls._states}
+        for tr, (from_states, to_state) in cls._transitions.items():
+            for fr in from_states:
+                table[fr][tr] = to_state
+        cls._table = table
+        cls._available = {s: frozenset(trs) for s, trs in table.items()}
+        cls._terminal_states = frozenset(s for s, trs in table.items() if not trs)
+        cls._paths = {}
+        cls._timeouts = {}
+        for tr, state, delay in cls.timeouts:
+            if state not in cls._states:
+                raise ImproperlyConfigured("Workflow {}: timeout for unknown state {}".format(cls.__name__, state))
+            if state in cls._timeouts:
+                raise ImproperlyConfigured("Workflow {}: several timeouts for state {}".format(cls.__name__, state))
+            if tr not in cls._table[state]:
+                raise ImproperlyConfigured("Workflow {}: timeout transition {} is not available from state {}"
+                                           .format(cls.__name__, tr, state))
+            cls._timeouts[state] = (tr, delay)
+        for old, new in cls.state_remap.items():
+            if old in cls._states or new not in cls._states:
+                raise InvalidStateRemap(cls.__name__, old)
+        for sc in cls.__subclasses__():  # lazy subclasses were not compiled to not inherit these tables
+            if '_table' not in sc.__dict__ and hasattr(sc, 'states') and hasattr(sc, 'transitions'):
+                sc.compile()
+
+    @classmethod
+    def shortest_paths(cls, state):
+        """ return the shortest sequence of transitions from state to each reachable state (breadth first search),
+            transitions being tried in their declaration order
+        """
+        paths, todo = {state: ()}, [state]
+        for current in todo:
+            for tr, to in cls._table[current].items():
+                if to not in paths:
+                    paths[to] = paths[current] + (tr,)
+                    todo.append(to)
+        return paths
+
+    @classmethod
+    def paths_from(cls, state):
+        """ return the shortest paths from state to each reachable state (see shortest_paths),
+            computed at first use and cached per source state, empty if state is not in the workflow
+        """
+        try:
+            return cls._paths[state]
+        except KeyError:
+            if state not in cls._states:
+                return {}
+            paths = cls._paths[state] = cls.shortest_paths(state)
+            return paths
+
     @classmethod
     def consistency_checks(cls, transitions):
-        """ format states and transitions and do some consistency checks
-        """
-        if not hasattr(cls, '_transitions'):
-            cls._states = {s[0] for s in cls.states}
-            if len(cls.states) != len(cls._states):
-                raise InconsistentStateList(cls.__name__)
-            cls._transitions = {tr: ((fr,), to) if isstring(fr) else (fr, to) for tr, fr, to in cls.transitions}
-            cls._transitions_set = set(cls._transitions)
-            for tr, v in cls._transitions.items():
-                if v[1] not in cls._states:
-                    raise InconsistentStateInTransition(cls.__name__, tr, 'final')
-                if not set(v[0]).issubset(cls._states):
-                    raise InconsistentStateInTransition(cls.__name__, tr, 'start')
+        """ check that the given transition methods are declared in the workflow
+        """
         if not cls.check_transitions(transitions, equiv=False):
             raise InvalidTransitionMethod(cls)
 
@@ -151,86 +533,955 @@ class KWorkFlow(object):
         """ find and return resulting state from current state and transition name,
             raise if wrong transition or wrong current state
         """
-        t = cls.find_transition(transition)
-        if state in t[0]:
-            return t[1]
+        try:
+            return cls._table[state][transition]
+        except KeyError:
+            pass
+        cls.find_transition(transition)  # raise if wrong transition
         raise InvalidStateForTransition(cls.__name__, transition, state)
 
+    @classmethod
+    def find_path(cls, state, target):
+        """ find the shortest path from state to target state and return it as a tuple of
+            (transition, from state, to state) steps, raise if target state is not reachable
+        """
+        try:
+            transitions = cls.paths_from(state)[target]
+        except KeyError:
+            raise UnreachableState(cls.__name__, state, target)
+        steps = []
+        for tr in transitions:
+            steps.append((tr, state, cls._table[state][tr]))
+            state = steps[-1][2]
+        return tuple(steps)
+
+    @classmethod
+    def reachable_states(cls, state):
+        """ return the set of states that can be reached from state, including itself
+        """
+        return frozenset(cls.paths_from(state))
+
+    @classmethod
+    def due_at(cls, state, now):
+        """ return the time an object entering state at 'now' times out, None if state has no timeout
+        """
+        timeout = cls._timeouts.get(state)
+        return now + timeout[1] if timeout else None
+
+    @classmethod
+    def is_available(cls, transition, state):
+        """ return True if transition can be performed from state
+        """
+        return transition in cls._available.get(state, ())
+
+    @classmethod
+    def available_transitions(cls, state):
+        """ return the set of transitions that can be performed from state
+        """
+        return cls._available.get(state, frozenset())
+
 
 class WorkflowMeta(ModelBase):
+    """
+    Check the transition methods of each model against its workflows at class creation,
+    or in the 'check_workflows' system check for lazy workflows, and the lookups of their guards
+    """
     def __init__(cls, *args):
         super().__init__(*args)
-        wf = getattr(cls, 'workflow', None)
-        if wf:
-            wf.consistency_checks(cls.get_transitions_methods())
+        for method in vars(cls).values():
+            if inspect.isfunction(method) and getattr(method, 'transition', False) and method.guard is not None:
+                check_guard_lookups(method.guard, cls)
+        for wf, methods in cls.get_workflows_transitions_methods():
+            if not wf.lazy:
+                wf.consistency_checks(methods)
 
 
 class KWorkFlowEnabled(models.Model, metaclass=WorkflowMeta):
     workflow = None
     histo = None
     histo_create = True  # if False, creation step will not be historised
+    retry_policy = None  # if None, the workflow retry policy is used
+    census = None  # optional census model (see WorkFlowCensus) maintaining the number of objects per state
+    census_shards = 1  # number of census rows per state, to spread the updates of hot counters
+    outbox = None  # optional outbox model (see WorkFlowOutbox) recording each transition in its transaction
+    timeout_field = None  # optional name of an indexed DateTimeField set to the time the state times out
+    concurrency = OPTIMISTIC  # if PESSIMISTIC, transitions are performed under a row lock
+    lock_nowait = False  # if True, locking a row already locked raises instead of waiting
     state_version = models.IntegerField(default=0)  # this is used for optimistic concurrency management
 
     class Meta:
         abstract = True
 
     @classmethod
-    def get_transitions_methods(cls):
-        """ get the list of methods with decorator 'transition'
+    def get_specific_fields(cls, using=None):
+        """ return the 'specific_fields' of a proxy class, with callables resolved (CachedLookup
+            in the database 'using') and id only lookups keyed by the field attname
+        """
+        if not getattr(cls._meta, 'proxy', None):
+            return {}
+        fields = {}
+        for k, v in cls.specific_fields.items():
+            if getattr(v, 'id_only', False):
+                k = cls._meta.get_field(k).attname
+            if isinstance(v, CachedLookup):
+                v = v(using)
+            fields[k] = v() if callable(v) else v
+        return fields
+
+    @classmethod
+    def get_workflow_proxies(cls):
+        """ return the proxy classes of the concrete model that define a workflow
+        """
+        proxies, todo = [], [cls._meta.concrete_model]
+        while todo:
+            for sc in todo.pop().__subclasses__():
+                todo.append(sc)
+                if sc._meta.proxy and sc.workflow:
+                    proxies.append(sc)
+        return proxies
+
+    @staticmethod
+    def resolve_proxies(proxies, using=None):
+        """ yield (proxy class, its resolved 'specific_fields') for each proxy class, skipping the proxies whose
+            lookups find no object (i.e. a proxy deployed before its related object is created): no object can be
+            of these proxies
+        """
+        for proxy in proxies:
+            try:
+                yield proxy, proxy.get_specific_fields(using)
+            except ObjectDoesNotExist:
+                continue
+
+    @classmethod
+    def get_proxy_index(cls, using=None):
+        """ return a list of (attnames, {values: proxy class}) giving the workflow proxy class
+            of an object from the values of its discriminator fields (the 'specific_fields' of the proxies,
+            resolved in the database 'using'), most specific first
+        """
+        index = {}
+        for proxy, specific_fields in cls.resolve_proxies(cls.get_workflow_proxies(), using):
+            fields = {cls._meta.get_field(k).attname: getattr(v, 'pk', v) for k, v in specific_fields.items()}
+            attnames = tuple(sorted(fields))
+            index.setdefault(attnames, {})[tuple(fields[a] for a in attnames)] = proxy
+        return sorted(index.items(), key=lambda x: -len(x[0]))
+
+    @classmethod
+    def get_workflow_filter(cls, states, guard=None, using=None):
+        """ return a Q object selecting the objects in the given states of their workflow:
+            for a proxy class, the objects matching its 'specific_fields' in states(workflow),
+            for the underlying model, an OR of this filter for each workflow proxy
+            :param states: a function returning a collection of states from a workflow class
+            :param guard: an optional function returning a Q object from a proxy class, combined with its filter
+            :param using: the database alias the 'specific_fields' are resolved in
+            :return: the Q object, or None if no state is selected
+        """
+        q = None
+        for proxy, specific_fields in cls.resolve_proxies([cls] if cls.workflow else cls.get_workflow_proxies(),
+                                                          using):
+            proxy_states = states(proxy.workflow)
+            if proxy_states:
+                proxy_q = models.Q(state__in=sorted(proxy_states), **specific_fields)
+                proxy_guard = guard and guard(proxy)
+                if proxy_guard is not None:
+                    proxy_q &= proxy_guard
+                q = proxy_q if q is None else q | proxy_q
+        return q
+
+    @classmethod
+    def get_suggested_indexes(cls):
+        """ return the composite indexes (as 'index_together' entries) serving the workflow filters:
+            the discriminator fields of the proxies followed by the state
+        """
+        indexes = []
+        for proxy in cls.get_workflow_proxies():
+            names = tuple(sorted(cls._meta.get_field(k).name for k in proxy.specific_fields)) + ('state',)
+            if names not in indexes:
+                indexes.append(names)
+        return indexes
+
+    @classmethod
+    def get_transitions_methods(cls, field='state'):
+        """ get the list of methods with decorator 'transition', for the given state field
+        """
+        return [k for k, v in cls.get_all_transitions_methods().items() if v.state_field == field]
+
+    @classmethod
+    def get_all_transitions_methods(cls):
+        """ return the methods with decorator 'transition' by name, found by walking the __dict__ of the classes
+            of the mro (much faster than inspect.getmembers on model classes)
+        """
+        members = {}
+        for klass in reversed(cls.__mro__):
+            members.update(vars(klass))
+        return {k: v for k, v in members.items() if getattr(v, 'transition', None) is True and inspect.isfunction(v)}
+
+    @classmethod
+    def get_workflows_transitions_methods(cls):
+        """ return a list of (workflow, transition methods names) for the workflow of the model, if any,
+            and the workflows of its additional state fields
         """
-        return [k for k, v in inspect.getmembers(cls, predicate=inspect.isfunction) if getattr(v, 'transition', None)]
+        methods = cls.get_all_transitions_methods()
+        result = []
+        for field in cls.get_state_fields():
+            wf = cls.workflow if field == 'state' else cls._meta.get_field(field).workflow
+            if wf:
+                result.append((wf, [k for k, v in methods.items() if v.state_field == field]))
+        return result
+
+    @classmethod
+    def get_state_fields(cls):
+        """ return the names of the state fields: 'state', then the additional state fields
+            (StateFields with a 'version_field')
+        """
+        return ['state'] + [f.name for f in cls._meta.fields if getattr(f, 'version_field', None)]
+
+    @classmethod
+    def get_version_field(cls, field='state'):
+        """ return the name of the version counter of a state field
+        """
+        return 'state_version' if field == 'state' else cls._meta.get_field(field).version_field
+
+    @classmethod
+    def get_transition_guard(cls, transition):
+        """ return the guard of a transition method, None if it has none
+        """
+        return getattr(getattr(cls, transition, None), 'guard', None)
+
+    @classmethod
+    def get_steps_guard(cls, steps):
+        """ return the Q object combining the guards of the transitions of (transition, from, to) steps,
+            None if they have none
+        """
+        q = None
+        for transition, _, _ in steps:
+            guard = cls.get_transition_guard(transition)
+            if guard is not None:
+                q = guard if q is None else q & guard
+        return q
+
+    def check_guard(self, transition):
+        """ evaluate the guard of a transition on the object in Python, without query
+            (unless the guard follows a relation): return true if the transition is allowed
+        """
+        guard = self.get_transition_guard(transition)
+        return guard is None or evaluate_guard(guard, self)
+
+    def get_state_workflow(self, field='state'):
+        """ return the workflow of a state field
+        """
+        return self.workflow if field == 'state' else self._meta.get_field(field).workflow
 
     def advance_state(self, transition):
         self.state = self.workflow.advance_state(transition, self.state)
         return self.state
 
-    @retry_once
-    def safe_advance_state(self, transition):
+    def get_retry_policy(self):
+        """ return the retry policy of the model, or of its workflow, or the default one
+        """
+        return self.retry_policy or getattr(self.workflow, 'retry_policy', None) or default_retry_policy
+
+    def state_as_of(self, timestamp):
+        """ return the state of the object at the given time from its history, None if it did not exist yet
+        """
+        if not self.histo:
+            raise MissingHistory(self.__class__.__name__)
+        record = self.histo._default_manager.filter(underlying=self.pk, timestamp__lte=timestamp) \
+            .order_by('-timestamp', '-pk').only('to_state').first()
+        return record.to_state if record else None
+
+    def reload_state(self, *fields):
+        """ reload state fields (defaults to 'state') and their versions from db
+        """
+        self.load_states(self.__class__._base_manager.db_manager(self._state.db).filter(pk=self.pk), fields)
+
+    def lock(self, *fields):
+        """ lock the row until the end of the current transaction and reload state fields (defaults to 'state')
+            and their versions
+        """
+        qs = self.__class__._base_manager.db_manager(self._state.db)
+        self.load_states(qs.select_for_update(nowait=self.lock_nowait).filter(pk=self.pk), fields)
+
+    def load_states(self, qs, fields):
+        names = []
+        for field in fields or ('state',):
+            names += [field, self.get_version_field(field)]
+        for name, value in zip(names, qs.values_list(*names).get()):
+            setattr(self, name, value)
+
+    def safe_advance_state(self, transition, refresh=False, field='state'):
         """ safe means using optimistic concurrency management
             see https://medium.com/@hakibenita/how-to-manage-concurrency-in-django-models-b240fed4ee2
+            On conflict, state is reloaded and the transition is retried according to the retry policy
             :param transition: the name of the transition to perform
+            :param refresh: if True, reload the whole instance from db after the transition,
+                            otherwise only the updated fields are set on the instance (no extra query)
+            :param field: the state field, for models with additional state fields
             :return: true if transition successfull
         """
-        old_state = self.state
-        if self.__class__.objects.filter(
-            uid=self.uid,
-            state_version=self.state_version
-        ).update(
-            modified_at=timezone.now(),
-            state=self.workflow.advance_state(transition, self.state),
-            state_version=self.state_version + 1
-        ):
-            self.refresh_from_db()
-            if self.histo:
-                self.histo.objects.create(from_state=old_state, to_state=self.state, underlying=self)
+        return self.run_retry_policy(functools.partial(self.try_advance_state, transition, refresh, field),
+                                     [field], transition)
+
+    def run_retry_policy(self, attempt, fields, name):
+        """ run an attempt to change state fields according to the retry policy, reloading the fields
+            before each retry, and raise FailAdvanceState on exhaustion if the policy says so
+            :return: true if the attempt succeeded
+        """
+        policy = self.get_retry_policy()
+        workflow_name = ', '.join(self.get_state_workflow(f).__name__ for f in fields)
+        # the db time covers the attempts and reloads, not the backoff sleeps between them
+        done = policy.run(metrics.db_timed(attempt), metrics.db_timed(functools.partial(self.reload_state, *fields)),
+                          name, workflow_name)
+        if done:
             return True
+        if policy.raise_on_exhaustion:
+            raise FailAdvanceState(workflow_name, name, ', '.join(getattr(self, f) for f in fields))
 
+    def try_advance_state(self, transition, refresh=False, field='state'):
+        """ single attempt of safe_advance_state
+            :return: true if transition successfull, false on concurrency conflict
+        """
+        return self.try_advance_states({field: transition}, refresh)
+
+    def safe_advance_states(self, refresh=False, **transitions):
+        """ advance several state fields with a single update conditioned by all their versions,
+            with the concurrency management of safe_advance_state
+            :param transitions: the name of the transition to perform by state field,
+                                i.e. state='finalize', billing_state='invoice'
+            :return: true if transitions successfull
+        """
+        fields = sorted(transitions)
+        return self.run_retry_policy(functools.partial(self.try_advance_states, transitions, refresh),
+                                     fields, ', '.join(transitions[f] for f in fields))
+
+    def try_advance_states(self, transitions, refresh=False):
+        """ single attempt of safe_advance_states
+            :return: true if transitions successfull, false on concurrency conflict
+        """
+        changes = {}
+        for field, transition in transitions.items():
+            state = getattr(self, field)
+            changes[field] = ((transition, state, self.get_state_workflow(field).advance_state(transition, state)),)
+        return self.apply_state_changes(changes, refresh)
+
+    def goto_state(self, target, refresh=False, field='state'):
+        """ move to target state along the shortest path of transitions, with a single conditional update
+            and a single history insert recording each step. Optimistic concurrency is managed as in
+            safe_advance_state: on conflict, state is reloaded and a new path is searched.
+            Only the state is advanced, transition methods are not called.
+            :param target: the state to reach, raise UnreachableState if there is no path to it
+            :param refresh: if True, reload the whole instance from db after the move
+            :param field: the state field, for models with additional state fields
+            :return: true if target state reached
+        """
+        return self.run_retry_policy(functools.partial(self.try_goto_state, target, refresh, field),
+                                     [field], 'goto_state({})'.format(target))
+
+    def try_goto_state(self, target, refresh=False, field='state'):
+        """ single attempt of goto_state
+            :return: true if target state reached, false on concurrency conflict
+        """
+        steps = self.get_state_workflow(field).find_path(getattr(self, field), target)
+        return self.apply_state_changes({field: steps}, refresh)
 
-class WorkflowEnabledManager(models.Manager):
+    def apply_state_changes(self, changes, refresh=False):
+        """ apply sequences of (transition, from state, to state) steps to state fields, starting from their
+            current states, with one update conditioned by their versions and the guards of the transitions.
+            History, census and outbox are maintained for the 'state' field only.
+            :param changes: the sequence of steps by state field
+            :return: true if steps applied, false on concurrency conflict, raise GuardFailed if a guard rejects them
+        """
+        changes = {field: steps for field, steps in changes.items() if steps}
+        if not changes:
+            return True
+        filters, values = {'pk': self.pk}, {'modified_at': timezone.now()}
+        for field, steps in changes.items():
+            version_field = self.get_version_field(field)
+            filters[version_field] = getattr(self, version_field)
+            values[field] = steps[-1][2]
+            values[version_field] = filters[version_field] + 1
+        if self.timeout_field and 'state' in changes:
+            values[self.timeout_field] = self.workflow.due_at(values['state'], values['modified_at'])
+        guard = self.get_steps_guard([step for steps in changes.values() for step in steps])
+        with transaction.atomic(using=self._state.db, savepoint=False):
+            # update through the concrete model: django updates a proxy model with an extra SELECT
+            qs = self._meta.concrete_model._base_manager.db_manager(self._state.db).filter(**filters)
+            updated = (qs if guard is None else qs.filter(guard)).update(**values)
+            # versions did not change: the update was rejected by the guard, not by a conflict
+            rejected = not updated and guard is not None and qs.exists()
+            if updated:
+                self.state_changes_applied(changes, values, refresh)
+        if rejected:  # raised out of the atomic block, not to break an enclosing transaction
+            raise GuardFailed(self.__class__.__name__,
+                              ', '.join(tr for steps in changes.values() for tr, _, _ in steps))
+        return bool(updated)
+
+    def state_changes_applied(self, changes, values, refresh):
+        """ update the instance and write the history, census and outbox records of applied state changes
+        """
+        if refresh:
+            self.refresh_from_db()
+        else:
+            for k, v in values.items():
+                setattr(self, k, v)
+        steps = changes.get('state')
+        if not steps:
+            return
+        old_state, new_state = steps[0][1], steps[-1][2]
+        if self.histo:
+            with metrics.timer('history.time', workflow=self.workflow.__name__):
+                write_history(*[self.histo(from_state=fr, to_state=to, underlying=self) for _, fr, to in steps])
+        if self.census:
+            self.census.objects.db_manager(self._state.db).move(self.workflow.__name__, old_state, new_state,
+                                                                shards=self.census_shards)
+        if self.outbox:
+            self.outbox.objects.db_manager(self._state.db).append(self, steps)
+
+
+def find_proxy(index, obj):
+    """ return the first workflow proxy class of a proxy index (see get_proxy_index) matching the discriminator
+        fields of an object, None if there is none
+    """
+    for attnames, proxies in index:
+        proxy = proxies.get(tuple(getattr(obj, a) for a in attnames))
+        if proxy:
+            return proxy
+    return None
+
+
+def polymorphic_objects(model, objs, using=None):
+    """ yield objects in the workflow proxy class matching their discriminator fields,
+        resolved in the database 'using'
+    """
+    index = model.get_proxy_index(using)
+    for obj in objs:
+        proxy = find_proxy(index, obj)
+        if proxy:
+            obj.__class__ = proxy
+        yield obj
+
+
+class PolymorphicModelIterable(ModelIterable):
+    """
+    Iterable that yields each object in the workflow proxy class matching its discriminator fields
+    """
+    def __iter__(self):
+        return polymorphic_objects(self.queryset.model, super().__iter__(), self.queryset.db)
+
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+class WorkflowEnabledQuerySet(models.QuerySet):
+    """
+    QuerySet for workflow enabled model
+    """
+
+    def polymorphic(self):
+        """ return a queryset yielding its objects in their workflow proxy class, without extra query
+            (callable 'specific_fields' are resolved once per evaluation, use CachedLookup to avoid queries)
+        """
+        clone = self._clone()
+        clone._iterable_class = PolymorphicModelIterable
+        return clone
+
+    def filter_workflow(self, states):
+        """ filter the queryset with the workflow filter of its model (see get_workflow_filter)
+        """
+        q = self.model.get_workflow_filter(states, using=self.db)
+        return self.none() if q is None else self.filter(q)
+
+    def can_transition(self, transition):
+        """ return the objects of the queryset that are in a valid state for the transition in their workflow
+            and satisfy the guard of the transition method of their proxy class
+        """
+        workflows = [self.model.workflow] if self.model.workflow else \
+            [proxy.workflow for proxy in self.model.get_workflow_proxies()]
+        if not any(transition in wf._transitions for wf in workflows):
+            raise InvalidTransitionName(self.model.__name__, transition)
+        q = self.model.get_workflow_filter(
+            lambda wf: wf._transitions[transition][0] if transition in wf._transitions else (),
+            guard=lambda proxy: proxy.get_transition_guard(transition), using=self.db)
+        return self.none() if q is None else self.filter(q)
+
+    def in_states(self, *states):
+        """ return the objects of the queryset that are in one of the given states of their workflow
+        """
+        return self.filter_workflow(lambda wf: wf._states.intersection(states))
+
+    def terminal(self):
+        """ return the objects of the queryset that are in a terminal state of their workflow
+        """
+        return self.filter_workflow(lambda wf: wf._terminal_states)
+
+    def history_sql(self, column, last=False, where=''):
+        """ return the sql of a subquery selecting 'column' of the history records of each object of the queryset
+            :param last: if True, select it from the last record only
+            :param where: an additional condition on the records, aliased 'h'
+        """
+        histo = self.model.histo
+        if not histo:
+            raise MissingHistory(self.model.__name__)
+        qn = connections[self.db].ops.quote_name
+        sql = 'SELECT {} FROM {} h WHERE h.{} = {}.{}'.format(
+            column, qn(histo._meta.db_table), qn(histo._meta.get_field('underlying').column),
+            qn(self.model._meta.db_table), qn(self.model._meta.pk.column))
+        if where:
+            sql += ' AND ' + where
+        if last:
+            sql += ' ORDER BY h.{} DESC, h.{} DESC LIMIT 1'.format(qn('timestamp'), qn(histo._meta.pk.column))
+        return sql
+
+    def with_history_count(self):
+        """ annotate each object with the number of its history records as 'history_count',
+            with a correlated subquery rather than a join, so it combines with other annotations
+        """
+        return self.annotate(history_count=RawSQL(self.history_sql('COUNT(*)'), (),
+                                                  output_field=models.IntegerField()))
+
+    def with_last_transition(self):
+        """ annotate each object with its last history record as 'last_from_state', 'last_to_state'
+            and 'last_transition_at' (None if it has no history), with correlated subqueries
+        """
+        qn = connections[self.db].ops.quote_name
+        annotations = {}
+        for name, column in (('from_state', 'from_state'), ('to_state', 'to_state'), ('transition_at', 'timestamp')):
+            sql = self.history_sql('h.{}'.format(qn(column)), last=True)
+            # output field of the history, to convert coded states
+            annotations['last_' + name] = RawSQL(sql, (), output_field=self.model.histo._meta.get_field(column))
+        return self.annotate(**annotations)
+
+    def with_state_as_of(self, timestamp, name='state_as_of'):
+        """ annotate each object with its state at the given time, i.e. the 'to_state' of its last history record
+            at this time (None if it did not exist yet), with a correlated subquery using the
+            (underlying, timestamp) index of the history table
+            :param timestamp: an aware datetime
+            :param name: the name of the annotation
+        """
+        histo = self.model.histo
+        qn = connections[self.db].ops.quote_name
+        sql = self.history_sql('h.{}'.format(qn('to_state')), last=True, where='h.{} <= %s'.format(qn('timestamp')))
+        value = histo._meta.get_field('timestamp').get_db_prep_value(timestamp, connections[self.db])
+        return self.annotate(**{name: RawSQL(sql, (value,), output_field=histo._meta.get_field('to_state'))})
+
+    def prefetch_histories(self, last=None, to_attr='last_histories'):
+        """ prefetch the history records of the objects, most recent first, in a list attribute of each object,
+            with a single query for all the objects
+            :param last: if set, only the last records of each object are loaded
+            :param to_attr: the attribute of the lists
+        """
+        histo = self.model.histo
+        if not histo:
+            raise MissingHistory(self.model.__name__)
+        fk = histo._meta.get_field('underlying')
+        qs = histo._default_manager.order_by('-timestamp', '-pk')
+        if last is not None:
+            qn = connections[self.db].ops.quote_name
+            table, pk = qn(histo._meta.db_table), qn(histo._meta.pk.column)
+            qs = qs.extra(where=['{table}.{pk} IN (SELECT h.{pk} FROM {table} h WHERE h.{fk} = {table}.{fk} '
+                                 'ORDER BY h.{ts} DESC, h.{pk} DESC LIMIT %s)'.format(
+                                     table=table, pk=pk, fk=qn(fk.column), ts=qn('timestamp'))],
+                          params=[last])
+        return self.prefetch_related(Prefetch(fk.remote_field.get_accessor_name(), queryset=qs, to_attr=to_attr))
+
+    def claim(self, state, limit):
+        """ lock and return up to 'limit' objects in the given state, ordered by pk, for a worker.
+            Rows locked by other workers are skipped on backends supporting SKIP LOCKED (postgresql),
+            so that workers do not wait for each other.
+            Must be called inside a transaction, rows are locked until its end.
+        """
+        return self.filter(state=state, **self.model.get_specific_fields(self.db)).order_by('pk').lock_rows(limit)
+
+    def due(self, now=None):
+        """ return the objects of the queryset whose state timed out at 'now' (defaults to now),
+            with a range scan of the index of the model 'timeout_field'
+        """
+        return self.filter(**{self.model.timeout_field + '__lte': now or timezone.now()})
+
+    def claim_due(self, limit, now=None):
+        """ lock and return up to 'limit' timed out objects, the oldest first (then by pk), same as claim
+        """
+        return self.due(now).filter(**self.model.get_specific_fields(self.db)).order_by(self.model.timeout_field, 'pk') \
+            .lock_rows(limit)
+
+    def lock_rows(self, limit):
+        """ lock and return up to 'limit' objects of the queryset, skipping locked rows if supported (see claim)
+        """
+        qs = self.select_for_update()[:limit]
+        sql, params = qs.query.get_compiler(self.db).as_sql()
+        if connections[self.db].vendor == 'postgresql':
+            sql += ' SKIP LOCKED'
+        objs = list(self.raw(sql, params, using=self.db))
+        if self._iterable_class is PolymorphicModelIterable:
+            objs = list(polymorphic_objects(self.model, objs, self.db))
+        return objs
+
+    def fire_timeouts(self, batch_size=100, now=None):
+        """ fire the timeout transitions of the timed out objects of the queryset, by calling their transition
+            methods, in batches of 'batch_size' objects claimed in a transaction, each one in a savepoint.
+            Batches are paginated on (due time, pk), so each object is claimed once per call: objects whose
+            transition fails or does not leave the state are retried at next call.
+            :return: the numbers of transitions 'fired' and 'failed'
+        """
+        qs, now, field = self.polymorphic(), now or timezone.now(), self.model.timeout_field
+        stats, after = {'fired': 0, 'failed': 0}, None
+        while True:
+            with transaction.atomic(using=self.db):
+                batch = qs if after is None else qs.filter(
+                    models.Q(**{field + '__gt': after[0]}) | models.Q(**{field: after[0], 'pk__gt': after[1]}))
+                objs = batch.claim_due(batch_size, now)
+                if objs:  # before the transitions change the due time
+                    after = (getattr(objs[-1], field), objs[-1].pk)
+                for obj in objs:
+                    state = obj.state
+                    timeout = getattr(obj.workflow, '_timeouts', {}).get(state)
+                    try:
+                        if timeout is None:  # the object has no workflow or its due time is stale
+                            raise LookupError("No timeout for state {}".format(state))
+                        with transaction.atomic(using=self.db):
+                            getattr(obj, timeout[0])()
+                        if obj.state == state:
+                            raise FailAdvanceState(obj.workflow.__name__, timeout[0], state)
+                        stats['fired'] += 1
+                    except Exception:
+                        stats['failed'] += 1
+                        logger.exception("Timeout of {} {} in state {} failed".format(
+                            obj.__class__.__name__, obj.pk, state))
+            if len(objs) < batch_size:
+                return stats
+
+    def bulk_transition(self, transition):
+        """ set-based version of safe_advance_state: advance all the objects of the queryset
+            that are in a valid state for the transition, with one UPDATE and one history INSERT
+            (chunked if the backend limits the number of query parameters).
+            Only the state is advanced, transition methods are not called.
+            On a proxy class queryset, objects not matching its 'specific_fields' are ignored,
+            on the underlying model queryset, the objects of each workflow proxy defining the transition are moved.
+            :param transition: the name of the transition to perform
+            :return: the list of pks of the objects that moved
+        """
+        if not any(transition in proxy.workflow._transitions for proxy in self.get_proxies()):
+            raise InvalidTransitionName(self.model.__name__, transition)
+        pks = []
+        with transaction.atomic(using=self.db):
+            for proxy, _ in self.model.resolve_proxies(self.get_proxies(), self.db):
+                if transition not in proxy.workflow._transitions:
+                    continue
+                from_states, to_state = proxy.workflow.find_transition(transition)
+                pks += self.bulk_move(from_states, to_state, lambda state, to=to_state: ((transition, state, to),),
+                                      model=proxy)
+        return pks
+
+    def bulk_goto_state(self, target):
+        """ set-based version of goto_state: move all the objects of the queryset from which target state
+            is reachable to this state, with one UPDATE and one history INSERT recording each step
+            of their shortest path. Same restrictions as bulk_transition.
+            :param target: the state to reach
+            :return: the list of pks of the objects that moved
+        """
+        if not any(target in proxy.workflow._states for proxy in self.get_proxies()):
+            workflow = self.model.workflow
+            raise UnreachableState(getattr(workflow, '__name__', self.model.__name__), '*', target)
+        pks = []
+        with transaction.atomic(using=self.db):
+            for proxy, _ in self.model.resolve_proxies(self.get_proxies(), self.db):
+                workflow = proxy.workflow
+                if target not in workflow._states:
+                    continue
+                from_states = [s for s in workflow._states if s != target and target in workflow.paths_from(s)]
+                pks += self.bulk_move(from_states, target, functools.partial(workflow.find_path, target=target),
+                                      model=proxy)
+        return pks
+
+    def get_proxies(self):
+        """ return the workflow classes whose objects bulk operations move: the model of the queryset
+            if it has a workflow, otherwise the workflow proxies of the underlying model
+        """
+        return [self.model] if self.model.workflow else self.model.get_workflow_proxies()
+
+    def bulk_move(self, from_states, to_state, steps, model=None):
+        """ move the objects of the queryset in from_states to to_state, that satisfy the guards of the steps
+            :param steps: a function returning the (transition, from state, to state) steps from a state,
+                          to be historised
+            :param model: the workflow proxy class whose objects are moved, defaults to the queryset model
+            :return: the list of pks of the objects that moved
+        """
+        model = model or self.model
+        guards = {state: model.get_steps_guard(steps(state)) for state in from_states}
+        if any(guard is not None for guard in guards.values()):  # each from state with the guards of its steps
+            q = models.Q()
+            for state, guard in guards.items():
+                q |= models.Q(state=state) if guard is None else models.Q(state=state) & guard
+        else:
+            q = models.Q(state__in=from_states)
+        with transaction.atomic(using=self.db, savepoint=False):  # in the transaction of the bulk operation
+            moved = list(self.filter(q, **model.get_specific_fields(self.db))
+                         .select_for_update().values_list('pk', 'state'))
+            pks = [pk for pk, _ in moved]
+            batch_size = max(connections[self.db].ops.bulk_batch_size(['pk'], pks), 1)
+            now = timezone.now()
+            values = {model.timeout_field: model.workflow.due_at(to_state, now)} if model.timeout_field else {}
+            for chunk in chunks(pks, batch_size):
+                # update through the concrete model: django updates a proxy model with an extra SELECT
+                model._meta.concrete_model._base_manager.using(self.db).filter(pk__in=chunk).update(
+                    modified_at=now,
+                    state=to_state,
+                    state_version=models.F('state_version') + 1,
+                    **values
+                )
+            state_steps = {state: steps(state) for state in {state for _, state in moved}}
+            if model.histo and moved:
+                model.histo.objects.using(self.db).bulk_create(
+                    [model.histo(from_state=fr, to_state=to, underlying_id=pk)
+                     for pk, state in moved for _, fr, to in state_steps[state]])
+            if model.census:
+                for state, n in Counter(state for _, state in moved).items():
+                    model.census.objects.db_manager(self.db).move(model.workflow.__name__, state, to_state, n,
+                                                                  shards=model.census_shards)
+            if model.outbox and moved:
+                model.outbox.objects.db_manager(self.db).append_many(
+                    model, [(pk, state_steps[state]) for pk, state in moved])
+        return pks
+
+    def remap_states(self, after=None, limit=1000):
+        """ remap the states of a chunk of objects of the queryset following the 'state_remap' of their workflow,
+            with their census counters, in a transaction (see remap_histories for their history records).
+            The chunk holds the 'limit' first objects of pk greater than 'after' (keyset pagination),
+            remapped objects get a new version, so that in flight transitions of these objects are retried.
+            :return: the last pk of the chunk (None if there is no object left) and the number of objects remapped
+        """
+        model, concrete = self.model, self.model._meta.concrete_model
+        remapped = 0
+        with transaction.atomic(using=self.db):
+            qs = self.order_by('pk') if after is None else self.filter(pk__gt=after).order_by('pk')
+            pks = list(qs.values_list('pk', flat=True)[:limit])
+            if not pks:
+                return None, 0
+            chunk = self.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            for proxy, specific_fields in model.resolve_proxies(self.get_proxies(), self.db):
+                remap = proxy.workflow.state_remap
+                if not remap:
+                    continue
+                moved = {}
+                for pk, state in chunk.filter(state__in=list(remap), **specific_fields) \
+                        .values_list('pk', 'state'):
+                    moved.setdefault(state, []).append(pk)
+                for old, old_pks in moved.items():
+                    new = remap[old]
+                    n = concrete._base_manager.using(self.db).filter(pk__in=old_pks, state=old).update(
+                        state=new, state_version=models.F('state_version') + 1)
+                    remapped += n
+                    if model.census and n:
+                        model.census.objects.db_manager(self.db).move(proxy.workflow.__name__, old, new, n,
+                                                                      shards=model.census_shards)
+        return pks[-1], remapped
+
+    def remap_histories(self, after=None, limit=1000):
+        """ remap the states of a chunk of history records of the objects of the queryset following the
+            'state_remap' of their workflow, whatever the current state of the objects, in a transaction.
+            The chunk holds the 'limit' first records with an old from or to state of pk greater than 'after'
+            (keyset pagination on the history table).
+            :return: the last pk of the chunk (None if there is no record left) and the number of records remapped
+        """
+        histo = self.model.histo
+        remaps = [(fields, proxy.workflow.state_remap)
+                  for proxy, fields in self.model.resolve_proxies(self.get_proxies(), self.db) if proxy.workflow.state_remap]
+        if histo is None or not remaps:
+            return None, 0
+        old_states = sorted({state for _, remap in remaps for state in remap})
+        histories = histo.objects.using(self.db)
+        remapped = 0
+        with transaction.atomic(using=self.db):
+            qs = histories.filter(models.Q(from_state__in=old_states) | models.Q(to_state__in=old_states),
+                                  underlying__in=self.values('pk'))
+            if after is not None:
+                qs = qs.filter(pk__gt=after)
+            pks = list(qs.order_by('pk').values_list('pk', flat=True)[:limit])
+            if not pks:
+                return None, 0
+            chunk = histories.filter(pk__gte=pks[0], pk__lte=pks[-1])
+            for fields, remap in remaps:
+                proxy_chunk = chunk.filter(underlying__in=self.filter(**fields).values('pk'))
+                remapped += proxy_chunk.filter(models.Q(from_state__in=list(remap)) |
+                                               models.Q(to_state__in=list(remap))).count()
+                for old, new in remap.items():
+                    proxy_chunk.filter(from_state=old).update(from_state=new)
+                    proxy_chunk.filter(to_state=old).update(to_state=new)
+        return pks[-1], remapped
+
+
+class WorkflowEnabledManager(models.Manager.from_queryset(WorkflowEnabledQuerySet)):
     """
     Manager for workflow enabled model
     """
 
+    def get_proxies_of(self, objs):
+        """ return the workflow class of each object: the model if it has a workflow, otherwise the workflow proxy
+            matching its discriminator fields (None if there is none, the object has no workflow)
+        """
+        if self.model.workflow:
+            return [self.model] * len(objs)
+        index = self.model.get_proxy_index(self.db)
+        return [find_proxy(index, obj) for obj in objs]
+
     def create(self, **kwargs):
-        if getattr(self.model._meta, 'proxy', None):
-            for k, v in self.model.specific_fields.items():
-                kwargs[k] = v() if callable(v) else v
-        new = super().create(**kwargs)
-        if self.model.histo and self.model.histo_create:
-            self.model.histo.objects.create(from_state=CREATION_STATE,
-                                            to_state=self.model.workflow.initial_state, underlying=new)
+        kwargs.update(self.model.get_specific_fields(self.db))
+        new = self.model(**kwargs)
+        proxy = self.get_proxies_of([new])[0]
+        workflow = proxy.workflow if proxy else None
+        if self.model.timeout_field and workflow:
+            setattr(new, self.model.timeout_field, workflow.due_at(kwargs.get('state', workflow.initial_state),
+                                                                   timezone.now()))
+        workflow_name = getattr(workflow, '__name__', None)
+        with metrics.measure('create', self.db, workflow=workflow_name), \
+                transaction.atomic(using=self.db, savepoint=False):
+            new.save(force_insert=True, using=self.db)
+            if workflow is None:  # an object of the underlying model matching no workflow proxy
+                return new
+            if self.model.histo and self.model.histo_create:
+                with metrics.timer('history.time', workflow=workflow_name):
+                    write_history(self.model.histo(from_state=CREATION_STATE,
+                                                   to_state=workflow.initial_state, underlying=new))
+            if self.model.census:
+                self.model.census.objects.db_manager(self.db).move(workflow_name, CREATION_STATE,
+                                                                   new.state, shards=self.model.census_shards)
+            if self.model.outbox:
+                self.model.outbox.objects.db_manager(self.db).append_many(
+                    proxy, [(new.pk, (('', CREATION_STATE, new.state),))])
         return new
 
+    def bulk_create(self, objs, batch_size=None):
+        """ create objects by chunks, with 'specific_fields' resolved once for all objects
+            and the workflow initial state applied, then write all their creation history
+            records with a single bulk_create.
+            Backends other than postgresql do not set the pks of bulk created objects,
+            they are then fetched by 'uid', once per chunk.
+            :param objs: the (unsaved) objects to create
+            :param batch_size: the number of objects inserted per query, defaults to the backend limit
+            :return: the list of created objects
+        """
+        model = self.model
+        objs = list(objs)
+        if not objs:
+            return objs
+        specific_fields = model.get_specific_fields(self.db)
+        now = timezone.now()
+        for obj in objs:
+            for k, v in specific_fields.items():
+                setattr(obj, k, v)
+            if model.workflow:
+                obj.state = model.workflow.initial_state
+        proxies = self.get_proxies_of(objs)
+        if model.timeout_field:
+            for obj, proxy in zip(objs, proxies):
+                if proxy:
+                    setattr(obj, model.timeout_field, proxy.workflow.due_at(obj.state, now))
+        batch_size = batch_size or connections[self.db].ops.bulk_batch_size(['uid'], objs)
+        with transaction.atomic(using=self.db):
+            for chunk in chunks(objs, max(batch_size, 1)):
+                super().bulk_create(chunk)
+                if chunk[0].pk is None:
+                    pks = dict(model._base_manager.using(self.db).filter(
+                        uid__in=[obj.uid for obj in chunk]).values_list('uid', 'pk'))
+                    for obj in chunk:
+                        obj.pk = pks[obj.uid]
+            tracked = [(obj, proxy) for obj, proxy in zip(objs, proxies) if proxy]  # objects with a workflow
+            if model.histo and model.histo_create and tracked:
+                model.histo.objects.using(self.db).bulk_create(
+                    [model.histo(from_state=CREATION_STATE, to_state=obj.state, underlying_id=obj.pk)
+                     for obj, _ in tracked])
+            if model.census:
+                counts = Counter((proxy.workflow.__name__, obj.state) for obj, proxy in tracked)
+                for (workflow_name, state), n in sorted(counts.items()):
+                    model.census.objects.db_manager(self.db).move(workflow_name, CREATION_STATE, state, n,
+                                                                  shards=model.census_shards)
+            if model.outbox:
+                changes = {}
+                for obj, proxy in tracked:
+                    changes.setdefault(proxy, []).append((obj.pk, (('', CREATION_STATE, obj.state),)))
+                for proxy, proxy_changes in changes.items():
+                    model.outbox.objects.db_manager(self.db).append_many(proxy, proxy_changes)
+        return objs
+
+
+class PolymorphicWorkflowManager(WorkflowEnabledManager):
+    """
+    Manager for workflow enabled model, whose querysets yield objects in their workflow proxy class
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().polymorphic()
+
+
+def transition(f=None, field='state', guard=None):
+    """ decorator of transition methods, use @transition(field=...) for a transition of an additional state field.
+        'guard' is an optional Q object on the model fields that objects must satisfy to perform the transition:
+        it is checked in Python before calling the method (raise GuardFailed), and added to the conditions
+        of the update, and of the can_transition and bulk operations filters.
+    """
+    if f is None:
+        return functools.partial(transition, field=field, guard=guard)
+    name = f.__name__
+
+    def perform(self, *args, **kwargs):
+        if not self.check_guard(name):
+            raise GuardFailed(self.__class__.__name__, name)
+        from_state = getattr(self, field)
+        pre_transition.send(sender=self.__class__, instance=self, transition=name, field=field,
+                            from_state=from_state)
+        result = f(self, functools.partial(self.safe_advance_state, name, field=field), *args, **kwargs)
+        post_transition.send(sender=self.__class__, instance=self, transition=name, field=field,
+                             from_state=from_state, to_state=getattr(self, field), result=result)
+        return result
 
-def transition(f):
     def wrapped(self, *args, **kwargs):
-        self.workflow.find_transition(f.__name__)  # check transition name
-        return f(self, functools.partial(self.safe_advance_state, f.__name__), *args, **kwargs)
-    wrapped.__name__ = f.__name__
+        workflow = self.get_state_workflow(field)
+        workflow.find_transition(name)  # check transition name
+        with metrics.measure('transition', self._state.db, split_db=True,
+                             workflow=workflow.__name__, transition=name):
+            if self.concurrency == PESSIMISTIC:
+                with transaction.atomic(using=self._state.db):
+                    self.lock(field)
+                    return perform(self, *args, **kwargs)
+            return perform(self, *args, **kwargs)
+    wrapped.__name__ = name
     wrapped.transition = True
+    wrapped.state_field = field
+    wrapped.guard = guard
     return wrapped
 
 
+@checks.register(checks.Tags.models)
+def check_workflows(app_configs=None, **kwargs):
+    """ system check compiling the lazy workflows and checking the transition methods of their models,
+        so that errors deferred by lazy compilation are reported at startup (i.e. by 'manage.py check')
+    """
+    errors = []
+    todo = [KWorkFlow]
+    while todo:
+        wf = todo.pop()
+        todo.extend(wf.__subclasses__())
+        if wf.lazy and '_table' not in wf.__dict__ and hasattr(wf, 'states') and hasattr(wf, 'transitions'):
+            try:
+                wf.compile()
+            except Exception as e:
+                errors.append(checks.Error(str(e), obj=wf, id='kworkflows.E001'))
+    if app_configs is None:
+        models_list = apps.get_models()
+    else:
+        models_list = [m for app_config in app_configs for m in app_config.get_models()]
+    for model in models_list:
+        if not issubclass(model, KWorkFlowEnabled):
+            continue
+        for proxy in [model] + [sc for sc in model.__subclasses__() if sc._meta.proxy]:
+            for wf, methods in proxy.get_workflows_transitions_methods():
+                if wf.lazy and '_table' in wf.__dict__ and not wf.check_transitions(methods, equiv=False):
+                    errors.append(checks.Error(str(InvalidTransitionMethod(wf.__name__)), obj=proxy,
+                                               id='kworkflows.E002'))
+    return errors
+
+
 class WorkFlowHistory(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
     from_state = models.CharField(max_length=20)
@@ -240,3 +1491,310 @@ class WorkFlowHistory(models.Model):
         abstract = True
         ordering = ['timestamp']
         get_latest_by = 'timestamp'
+        index_together = [('underlying', 'timestamp')]  # for point in time queries, see state_as_of
+
+
+class WorkFlowCensusManager(models.Manager):
+    """
+    Manager for census models
+    """
+
+    def add(self, workflow, state, n, shards=1):
+        """ add n (can be negative) to the count of objects in state for workflow, on a random shard
+        """
+        shard = random.randrange(shards)
+        counter = self.filter(workflow=workflow, state=state, shard=shard)
+        if not counter.update(count=models.F('count') + n):
+            try:
+                with transaction.atomic(using=self.db):
+                    self.create(workflow=workflow, state=state, shard=shard, count=n)
+            except IntegrityError:  # created concurrently
+                counter.update(count=models.F('count') + n)
+
+    def move(self, workflow, from_state, to_state, n=1, shards=1):
+        """ move the count of n objects from a state to another one, for workflow
+        """
+        moves = [(to_state, n)] if from_state == CREATION_STATE else [(from_state, -n), (to_state, n)]
+        for state, delta in sorted(moves):  # always lock counters in the same order, to avoid deadlocks
+            self.add(workflow, state, delta, shards)
+
+    def counts(self, workflow=None):
+        """ return the number of objects by (workflow, state), or by state if a workflow name is given
+        """
+        qs = self.all() if workflow is None else self.filter(workflow=workflow)
+        rows = qs.values_list('workflow', 'state').annotate(models.Sum('count')).order_by()
+        if workflow is None:
+            return {(wf, state): n for wf, state, n in rows}
+        return {state: n for _, state, n in rows}
+
+
+class WorkFlowCensus(models.Model):
+    """
+    Number of objects per workflow and state, maintained by transitions and creations
+    Each counter is spread over the 'census_shards' rows of the workflow enabled model
+    """
+    workflow = models.CharField(max_length=64)
+    state = models.CharField(max_length=20)
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    objects = WorkFlowCensusManager()
+
+    class Meta:
+        abstract = True
+        unique_together = ('workflow', 'state', 'shard')
+
+
+class WorkFlowOutboxManager(models.Manager):
+    """
+    Manager for outbox models
+    """
+
+    def append(self, obj, steps):
+        """ record the (transition, from state, to state) steps of an object
+        """
+        self.append_many(type(obj), [(obj.pk, steps)])
+
+    def append_many(self, model, changes):
+        """ record the steps of several objects of a model, with a single INSERT
+            :param changes: a list of (pk, steps)
+        """
+        label, workflow = model._meta.concrete_model._meta.label, model.workflow.__name__
+        records = [self.model(model=label, object_pk=str(pk), workflow=workflow,
+                              transition=tr, from_state=fr, to_state=to)
+                   for pk, steps in changes for tr, fr, to in steps]
+        if len(records) == 1:
+            records[0].save(using=self.db)
+        elif records:
+            self.bulk_create(records)
+
+    def read(self, after=0, limit=100, lag=None):
+        """ return the next batch of events after a cursor, in sequence order.
+            Consumers store the id of the last event they processed as their cursor, once processed:
+            delivery is at least once.
+            Sequence ids are allocated at insert time, so a transaction may commit an event after
+            another transaction committed a greater id. Use 'lag' to only read events older than
+            this number of seconds, so that such late commits are not skipped.
+            :param after: the cursor, 0 to read from the beginning
+            :param limit: the maximum number of events returned
+            :param lag: if set, events created less than lag seconds ago are not returned
+        """
+        qs = self.filter(id__gt=after)
+        if lag:
+            qs = qs.filter(created_at__lte=timezone.now() - timedelta(seconds=lag))
+        return list(qs.order_by('id')[:limit])
+
+    def last_id(self):
+        """ return the id of the last event, to start consuming from now, or 0 if there is none
+        """
+        return self.aggregate(last=models.Max('id'))['last'] or 0
+
+    def prune(self, up_to=None, older_than=None):
+        """ delete the events consumed by all consumers (with an id lower or equal to up_to)
+            and/or the events older than a retention delay
+            :param up_to: the lowest cursor of the consumers
+            :param older_than: the retention delay as a timedelta
+            :return: the number of deleted events
+        """
+        if up_to is None and older_than is None:
+            return 0
+        qs = self.all()
+        if up_to is not None:
+            qs = qs.filter(id__lte=up_to)
+        if older_than is not None:
+            qs = qs.filter(created_at__lt=timezone.now() - older_than)
+        return qs.delete()[0]  # events have no relations nor signals: a single DELETE, without fetching them
+
+
+class WorkFlowOutbox(models.Model):
+    """
+    Transactional outbox of a workflow enabled model: each creation and transition appends an event
+    in the transaction updating the state, so that consumers can tail the changes with range scans
+    on a sequence id (see 'read'). Creation events have an empty transition.
+    """
+    id = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    workflow = models.CharField(max_length=64)
+    transition = models.CharField(max_length=64)
+    from_state = models.CharField(max_length=20)
+    to_state = models.CharField(max_length=20)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = WorkFlowOutboxManager()
+
+    class Meta:
+        abstract = True
+
+
+_local = threading.local()
+
+
+def write_history(*records):
+    """ save history records (with a single query if several), or add them to the current HistoryBuffer if any
+    """
+    buffer = getattr(_local, 'history_buffer', None)
+    if buffer is not None:
+        for record in records:
+            buffer.add(record)
+    elif len(records) == 1:
+        records[0].save()
+    elif records:  # in the database of their object
+        type(records[0]).objects.db_manager(records[0]._state.db).bulk_create(records)
+
+
+def common_prefix(a, b):
+    """ return the common prefix of two tuples of savepoint ids, b being None outside a transaction
+    """
+    prefix = ()
+    for x, y in zip(a, b or ()):
+        if x != y:
+            break
+        prefix += (x,)
+    return prefix
+
+
+def reset_records(records):
+    """ prepare records whose insert rolled back to be inserted again
+    """
+    for record in records:
+        record.pk = None
+        record._state.adding = True
+    return records
+
+
+class HistoryBuffer(object):
+    """
+    Context manager collecting the history records of the transitions performed in its block (in the current thread),
+    to write them with one bulk_create per history model when the block ends or, for a block inside a transaction,
+    when the transaction commits. Records of transactions or savepoints that roll back are never written.
+    Params:
+    flush_size: when the number of buffered records reaches this size, they are written immediately
+                (inside a transaction, they are then part of it, in the current savepoint), so that the buffer
+                is bounded. Records of other savepoints written in a nested savepoint are kept until they share
+                its fate, to be buffered again if this savepoint alone rolls back
+    using: the database alias
+    Usage:
+    with transaction.atomic(), HistoryBuffer():
+        order.submit()
+        order.finalize()
+    """
+    def __init__(self, flush_size=1000, using=None):
+        self.flush_size = flush_size
+        self.using = using
+        self.size = 0
+        self.groups = {}  # records of uncommitted transactions and their on commit callback, by savepoint ids
+        self.committed = []  # records of committed transactions, to be written at the end of the block
+        # records flushed in a nested savepoint: (their savepoint ids, their callback, the savepoint ids they were
+        # written in, the token and callback of this savepoint, the records)
+        self.flushed = []
+        self.ran = set()  # savepoint ids and tokens of the callbacks of flushed records run on commit
+        self.open = False
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'history_buffer', None)
+        _local.history_buffer = self
+        self.open = True
+        return self
+
+    def __exit__(self, *args):
+        _local.history_buffer = self.previous
+        key = self.savepoint_ids()
+        self.resolve(key, self.pending_callbacks() if key is not None else set())
+        del self.flushed[:]  # the savepoints opened in the block are closed: all records share the same fate
+        self.ran.clear()
+        self.open = False
+        self.write(self.committed)
+        self.groups = {}  # the remaining records are written on commit
+
+    def add(self, record):
+        key = self.savepoint_ids()
+        if key is None:
+            if self.flushed:
+                self.resolve(None, set())
+            records = self.committed
+        else:
+            pending = self.pending_callbacks()
+            if self.flushed:
+                self.resolve(key, pending)
+            records, callback = self.groups.get(key, (None, None))
+            if records is None or callback not in pending:  # new or rolled back transaction
+                records = []
+                callback = functools.partial(self.on_commit, key, records)
+                self.groups[key] = (records, callback)
+                # registered in the innermost savepoint: dropped by django if this savepoint rolls back
+                transaction.on_commit(callback, using=self.using)
+        records.append(record)
+        self.size += 1
+        if self.size >= self.flush_size:
+            self.flush()
+
+    def on_commit(self, key, records):
+        if self.groups.get(key, (None,))[0] is records:
+            del self.groups[key]
+        if self.open:
+            if any(entry[0] == key for entry in self.flushed):
+                self.ran.add(key)
+            self.committed.extend(records)
+            del records[:]
+        else:
+            self.write(records)
+
+    def savepoint_ids(self):
+        connection = transaction.get_connection(self.using)
+        return tuple(connection.savepoint_ids) if connection.in_atomic_block else None
+
+    def pending_callbacks(self):
+        return {f for _, f in transaction.get_connection(self.using).run_on_commit}
+
+    def flush(self):
+        """ write now the records of committed transactions and of the savepoints that did not roll back
+            (current, outer or released ones), in the current savepoint
+        """
+        self.write(self.committed)
+        current = self.savepoint_ids()
+        if current is not None:
+            pending = self.pending_callbacks()
+            self.resolve(current, pending)
+            token = detector = None
+            for key, (records, callback) in list(self.groups.items()):
+                if callback not in pending:  # rolled back
+                    del self.groups[key]
+                    continue
+                if records and common_prefix(key, current) != current:  # they do not share the current fate
+                    if detector is None:
+                        token = object()
+                        detector = functools.partial(self.ran.add, token)
+                        transaction.on_commit(detector, using=self.using)
+                    self.flushed.append((key, callback, current, token, detector, list(records)))
+                self.write(records)
+        self.size = 0
+
+    def resolve(self, current, pending):
+        """ settle the records flushed in a nested savepoint: buffer them again if this savepoint rolled back
+            but not theirs, forget them once both savepoints share the same fate
+            :param current: the current savepoint ids, None outside a transaction
+            :param pending: the on commit callbacks of the current transaction
+        """
+        for entry in list(self.flushed):
+            key, callback, written_in, token, detector, records = entry
+            if callback in pending:
+                if detector in pending and common_prefix(key, current) != common_prefix(written_in, current):
+                    continue  # still written in a nested savepoint
+                if detector not in pending and self.groups.get(key, (None, None))[1] is callback:
+                    self.groups[key][0].extend(reset_records(records))
+                    self.size += len(records)
+            elif key in self.ran and token not in self.ran:  # committed, but their writes rolled back
+                self.committed.extend(reset_records(records))
+                self.size += len(records)
+            self.flushed.remove(entry)
+        if not self.flushed:
+            self.ran.clear()
+
+    def write(self, records):
+        by_model = {}
+        for record in records:
+            by_model.setdefault(type(record), []).append(record)
+        del records[:]  # written once, even if also registered on commit
+        for model, model_records in by_model.items():
+            model.objects.using(self.using).bulk_create(model_records)